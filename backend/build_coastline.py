@@ -0,0 +1,144 @@
+# Gera o raster de distância até a costa usado por star.py para decidir
+# quando consultar a API marinha.
+#
+# Entrada: GeoJSON de polígonos de terra (ex.: Natural Earth ne_10m_land.geojson).
+# Uso: python build_coastline.py ne_10m_land.geojson data/coastline.bin --resolution 0.1
+from array import array
+import argparse
+import json
+import math
+import os
+
+from star import COASTLINE_HEADER, COASTLINE_MAGIC
+
+LAT0, LON0 = -90.0, -180.0
+KM_PER_DEGREE_LAT = 110.57
+KM_PER_DEGREE_LON = 111.32
+
+
+def polygon_rings(geojson: dict):
+    features = geojson['features'] if geojson.get('type') == 'FeatureCollection' else [geojson]
+    for feature in features:
+        geometry = feature.get('geometry', feature)
+        if geometry['type'] == 'Polygon':
+            yield from geometry['coordinates']
+        elif geometry['type'] == 'MultiPolygon':
+            for polygon in geometry['coordinates']:
+                yield from polygon
+
+
+def rasterize_land(rings, resolution: float, rows: int, cols: int) -> bytearray:
+    # Preenchimento por linha de varredura (regra par-ímpar) no centro de cada célula
+    crossings = [[] for _ in range(rows)]
+    for ring in rings:
+        for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+            if y1 == y2:
+                continue
+            ymin, ymax = min(y1, y2), max(y1, y2)
+            first = max(math.ceil((ymin - LAT0) / resolution - 0.5), 0)
+            last = min(math.ceil((ymax - LAT0) / resolution - 0.5), rows)
+            slope = (x2 - x1) / (y2 - y1)
+            for row in range(first, last):
+                yc = LAT0 + (row + 0.5) * resolution
+                crossings[row].append(x1 + (yc - y1) * slope)
+
+    land = bytearray(rows * cols)
+    for row, xs in enumerate(crossings):
+        xs.sort()
+        for xa, xb in zip(xs[0::2], xs[1::2]):
+            start = max(math.ceil((xa - LON0) / resolution - 0.5), 0)
+            end = min(math.ceil((xb - LON0) / resolution - 0.5), cols)
+            if end > start:
+                land[row * cols + start:row * cols + end] = b'\x01' * (end - start)
+    return land
+
+
+def distance_to_sea(land: bytearray, resolution: float, rows: int, cols: int) -> array:
+    # Transformada de distância chamfer em duas passadas, em km. As colunas são
+    # vizinhas módulo cols, como na consulta (CoastlineRaster.distance_km).
+    inf = float('inf')
+    dist = array('f', (inf if cell else 0.0 for cell in land))
+    dy = resolution * KM_PER_DEGREE_LAT
+    dxs = [resolution * KM_PER_DEGREE_LON * max(math.cos(math.radians(LAT0 + (r + 0.5) * resolution)), 1e-3)
+           for r in range(rows)]
+
+    for r in range(rows):
+        dx = dxs[r]
+        diag = math.hypot(dx, dy)
+        base, prev = r * cols, (r - 1) * cols
+        for c in range(cols):
+            i = base + c
+            if not land[i]:
+                continue
+            left, right = (c - 1) % cols, (c + 1) % cols
+            d = dist[i]
+            if dist[base + left] + dx < d:
+                d = dist[base + left] + dx
+            if r > 0:
+                if dist[prev + c] + dy < d:
+                    d = dist[prev + c] + dy
+                if dist[prev + left] + diag < d:
+                    d = dist[prev + left] + diag
+                if dist[prev + right] + diag < d:
+                    d = dist[prev + right] + diag
+            dist[i] = d
+        # A linha dá a volta no antimeridiano: o que a última coluna ganhou
+        # ainda pode melhorar as primeiras
+        for c in range(cols):
+            d = dist[base + (c - 1) % cols] + dx
+            if d >= dist[base + c]:
+                break
+            dist[base + c] = d
+
+    for r in range(rows - 1, -1, -1):
+        dx = dxs[r]
+        diag = math.hypot(dx, dy)
+        base, nxt = r * cols, (r + 1) * cols
+        for c in range(cols - 1, -1, -1):
+            i = base + c
+            if not land[i]:
+                continue
+            left, right = (c - 1) % cols, (c + 1) % cols
+            d = dist[i]
+            if dist[base + right] + dx < d:
+                d = dist[base + right] + dx
+            if r < rows - 1:
+                if dist[nxt + c] + dy < d:
+                    d = dist[nxt + c] + dy
+                if dist[nxt + left] + diag < d:
+                    d = dist[nxt + left] + diag
+                if dist[nxt + right] + diag < d:
+                    d = dist[nxt + right] + diag
+            dist[i] = d
+        for c in range(cols - 1, -1, -1):
+            d = dist[base + (c + 1) % cols] + dx
+            if d >= dist[base + c]:
+                break
+            dist[base + c] = d
+    return dist
+
+
+def build(input_path: str, output_path: str, resolution: float):
+    rows, cols = round(180 / resolution), round(360 / resolution)
+    with open(input_path, encoding='utf-8') as f:
+        rings = list(polygon_rings(json.load(f)))
+
+    land = rasterize_land(rings, resolution, rows, cols)
+    dist = distance_to_sea(land, resolution, rows, cols)
+    # 0 = mar; terra guarda a distância em km arredondada para cima, entre 1 e 255
+    cells = bytes(min(255, max(1, math.ceil(d))) if is_land else 0 for d, is_land in zip(dist, land))
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'wb') as f:
+        f.write(COASTLINE_HEADER.pack(COASTLINE_MAGIC, 1, resolution, LAT0, LON0, rows, cols))
+        f.write(cells)
+    print(f"{output_path}: {rows}x{cols} células, {sum(land)} em terra")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gera o raster de distância até a costa.")
+    parser.add_argument("input", help="GeoJSON com polígonos de terra")
+    parser.add_argument("output", help="arquivo de saída (ex.: data/coastline.bin)")
+    parser.add_argument("--resolution", type=float, default=0.1, help="resolução da grade em graus")
+    args = parser.parse_args()
+    build(args.input, args.output, args.resolution)
@@ -0,0 +1,200 @@
+# Gera o gazetteer offline usado por star.py para responder /cities sem a API de
+# geocodificação.
+#
+# Entrada: dump de cidades do GeoNames (ex.: cities15000.txt) e, opcionalmente,
+# countryInfo.txt e admin1CodesASCII.txt para os nomes de países e estados.
+# Com alternateNamesV2.txt os nomes exibidos (cidade, estado e país) saem no idioma
+# de --language (padrão pt), como os da API de geocodificação com language=pt;
+# sem ele ficam os nomes padrão do GeoNames, em geral em inglês.
+# Uso: python build_gazetteer.py cities15000.txt data/gazetteer.bin \
+#          --countries countryInfo.txt --admin1 admin1CodesASCII.txt \
+#          --localized-names alternateNamesV2.txt
+from array import array
+import argparse
+import heapq
+import os
+
+from star import (GAZETTEER_EMPTY_ROW, GAZETTEER_HEADER, GAZETTEER_MAGIC, GAZETTEER_VERSION, SUGGEST_TOP_K,
+                  gazetteer_layout, name_trigrams, normalize_name, trigram_code)
+
+# Prefixos que cobrem mais chaves que isso ganham top-k pré-calculado
+PREFIX_THRESHOLD = 128
+
+
+def read_tsv(path: str):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            yield line.rstrip('\n').split('\t')
+
+
+def read_localized_names(path: str, language: str) -> dict:
+    # geonameid -> nome no idioma pedido. Preferidos (isPreferredName) vêm antes dos
+    # curtos (isShortName), que vêm antes dos demais; coloquiais e históricos ficam de fora.
+    best = {}
+    for cols in read_tsv(path):
+        if cols[2] != language or '1' in cols[6:8]:
+            continue
+        geoname_id = int(cols[1])
+        rank = (cols[4:5] != ['1'], cols[5:6] != ['1'])
+        if geoname_id not in best or rank < best[geoname_id][0]:
+            best[geoname_id] = (rank, cols[3])
+    return {geoname_id: name for geoname_id, (_, name) in best.items()}
+
+
+def read_cities(path: str, countries: dict, admin1: dict, min_population: int,
+                alternate_names: bool, localized: dict) -> list:
+    cities = []
+    for cols in read_tsv(path):
+        population = int(cols[14] or 0)
+        if population < min_population:
+            continue
+        country_code = cols[8]
+        name = localized.get(int(cols[0]), cols[1])
+        names = {name, cols[1], cols[2]}
+        if alternate_names and cols[3]:
+            names.update(cols[3].split(','))
+        cities.append({
+            'id': int(cols[0]),
+            'name': name,
+            'latitude': float(cols[4]),
+            'longitude': float(cols[5]),
+            'country': countries.get(country_code, country_code),
+            'country_code': country_code,
+            'admin1': admin1.get(f"{country_code}.{cols[10]}", ''),
+            'population': population,
+            'keys': {normalize_name(n) for n in names if n.strip()},
+        })
+    # Linha 0 = cidade mais populosa
+    cities.sort(key=lambda city: (-city['population'], city['id']))
+    return cities
+
+
+def heavy_prefixes(keys: list, top_k: int, threshold: int = PREFIX_THRESHOLD) -> list:
+    # keys: [(chave, linha)] ordenadas. Desce nível a nível (em bytes) só pelos
+    # intervalos de chaves que ainda passam do limiar.
+    result = []
+    ranges = [(0, len(keys))]
+    depth = 0
+    while ranges:
+        depth += 1
+        heavy = []
+        for start, end in ranges:
+            i = start
+            while i < end:
+                if len(keys[i][0]) < depth:
+                    i += 1
+                    continue
+                prefix = keys[i][0][:depth]
+                j = i + 1
+                while j < end and keys[j][0][:depth] == prefix:
+                    j += 1
+                if j - i > threshold:
+                    rows = heapq.nsmallest(top_k, {row for _, row in keys[i:j]})
+                    result.append((prefix, rows))
+                    heavy.append((i, j))
+                i = j
+        ranges = heavy
+    result.sort()
+    return result
+
+
+def localized_name(localized: dict, geoname_id: str, default: str) -> str:
+    return localized.get(int(geoname_id), default) if geoname_id.isdigit() else default
+
+
+def build(input_path: str, output_path: str, countries_path: str = None, admin1_path: str = None,
+          min_population: int = 0, alternate_names: bool = True, localized_names_path: str = None,
+          language: str = 'pt'):
+    localized = read_localized_names(localized_names_path, language) if localized_names_path else {}
+    # countryInfo.txt: geonameid do país na coluna 16; admin1CodesASCII.txt: na coluna 3
+    countries = {cols[0]: localized_name(localized, cols[16] if len(cols) > 16 else '', cols[4])
+                 for cols in read_tsv(countries_path)} if countries_path else {}
+    admin1 = {cols[0]: localized_name(localized, cols[3] if len(cols) > 3 else '', cols[1])
+              for cols in read_tsv(admin1_path)} if admin1_path else {}
+    cities = read_cities(input_path, countries, admin1, min_population, alternate_names, localized)
+
+    text, text_offsets = bytearray(), array('I', [0])
+    trigram_counts = array('H')
+    keys, postings_by_code = [], {}
+    for row, city in enumerate(cities):
+        text += f"{city['name']}\t{city['country']}\t{city['admin1']}\t{city['country_code']}".encode()
+        text_offsets.append(len(text))
+        keys.extend((key.encode(), row) for key in city['keys'])
+        grams = name_trigrams(normalize_name(city['name']))
+        trigram_counts.append(min(len(grams), 65535))
+        for gram in grams:
+            postings_by_code.setdefault(trigram_code(gram), []).append(row)
+
+    keys.sort()
+    key_blob, key_offsets, key_rows = bytearray(), array('I', [0]), array('I')
+    for key, row in keys:
+        key_blob += key
+        key_offsets.append(len(key_blob))
+        key_rows.append(row)
+
+    prefixes = heavy_prefixes(keys, SUGGEST_TOP_K)
+    prefix_blob, prefix_offsets, prefix_top = bytearray(), array('I', [0]), array('I')
+    for prefix, rows in prefixes:
+        prefix_blob += prefix
+        prefix_offsets.append(len(prefix_blob))
+        prefix_top.extend(rows + [GAZETTEER_EMPTY_ROW] * (SUGGEST_TOP_K - len(rows)))
+
+    trigrams = array('I', sorted(postings_by_code))
+    posting_offsets, postings = array('I', [0]), array('I')
+    for code in trigrams:
+        postings.extend(postings_by_code[code])
+        posting_offsets.append(len(postings))
+
+    sections = {
+        'ids': array('I', (city['id'] for city in cities)),
+        'latitude': array('f', (city['latitude'] for city in cities)),
+        'longitude': array('f', (city['longitude'] for city in cities)),
+        'population': array('I', (city['population'] for city in cities)),
+        'trigram_counts': trigram_counts,
+        'id_order': array('I', sorted(range(len(cities)), key=lambda row: cities[row]['id'])),
+        'text_offsets': text_offsets,
+        'key_offsets': key_offsets,
+        'key_rows': key_rows,
+        'trigrams': trigrams,
+        'posting_offsets': posting_offsets,
+        'postings': postings,
+        'prefix_offsets': prefix_offsets,
+        'prefix_top': prefix_top,
+        'text': bytes(text),
+        'keys': bytes(key_blob),
+        'prefix_keys': bytes(prefix_blob),
+    }
+    counts = (len(cities), len(key_rows), len(trigrams), len(postings), len(text), len(key_blob),
+              len(prefixes), len(prefix_blob), SUGGEST_TOP_K)
+    layout, size = gazetteer_layout(*counts)
+
+    out = bytearray(size)
+    GAZETTEER_HEADER.pack_into(out, 0, GAZETTEER_MAGIC, GAZETTEER_VERSION, *counts)
+    for name, (offset, _, _) in layout.items():
+        data = sections[name]
+        data = data.tobytes() if isinstance(data, array) else data
+        out[offset:offset + len(data)] = data
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'wb') as f:
+        f.write(out)
+    print(f"{output_path}: {len(cities)} cidades, {len(key_rows)} chaves, {len(trigrams)} trigramas, "
+          f"{len(prefixes)} prefixos pré-calculados, {size} bytes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gera o gazetteer offline a partir do GeoNames.")
+    parser.add_argument("input", help="dump de cidades do GeoNames (ex.: cities15000.txt)")
+    parser.add_argument("output", help="arquivo de saída (ex.: data/gazetteer.bin)")
+    parser.add_argument("--countries", help="countryInfo.txt do GeoNames")
+    parser.add_argument("--admin1", help="admin1CodesASCII.txt do GeoNames")
+    parser.add_argument("--min-population", type=int, default=0)
+    parser.add_argument("--no-alternate-names", action="store_true",
+                        help="não indexa os nomes alternativos (arquivo menor)")
+    parser.add_argument("--localized-names", help="alternateNamesV2.txt do GeoNames (nomes no idioma de --language)")
+    parser.add_argument("--language", default="pt", help="código ISO do idioma dos nomes exibidos (padrão: pt)")
+    args = parser.parse_args()
+    build(args.input, args.output, args.countries, args.admin1, args.min_population, not args.no_alternate_names,
+          args.localized_names, args.language)
@@ -1,17 +1,177 @@
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, TypeAdapter
+from requests.adapters import HTTPAdapter
+from sqlalchemy import Column, Float, MetaData, String, Table, Text, create_engine, delete, event, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateIndex, CreateTable
+from starlette.concurrency import run_in_threadpool
+from collections import OrderedDict, deque
+from typing import Callable, List, NamedTuple, Optional, Tuple
+from bisect import bisect_left
+from datetime import datetime, timezone
+import asyncio
+import heapq
+import json
+import math
+import mmap
 import requests
 import logging
+import os
+import queue
+import random
+import struct
+import threading
+import time
+import unicodedata
+import zlib
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- URLs ---
 GEOCODING_API_URL = "https://geocoding-api.open-meteo.com/v1/search"
+GEOCODING_GET_API_URL = "https://geocoding-api.open-meteo.com/v1/get"
 MARINE_API_URL = "https://marine-api.open-meteo.com/v1/marine"
 STANDARD_API_URL = "https://api.open-meteo.com/v1/forecast"
 
+# --- Configuração do cliente upstream ---
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "10"))
+UPSTREAM_POOL_MAXSIZE = int(os.getenv("UPSTREAM_POOL_MAXSIZE", "20"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "0") == "1"
+# Circuit breaker por endpoint: abre quando, nas últimas BREAKER_WINDOW chamadas,
+# a fração de erros ou de chamadas mais lentas que BREAKER_SLOW_CALL_SECONDS
+# passa de BREAKER_FAILURE_RATE; após BREAKER_OPEN_SECONDS uma chamada de teste passa
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+# Latências das últimas chamadas bem-sucedidas, usadas para estimar o p95
+UPSTREAM_LATENCY_WINDOW = int(os.getenv("UPSTREAM_LATENCY_WINDOW", "200"))
+# Hedging: chamada que passa do p95 observado ganha uma cópia em paralelo, limitado
+# a UPSTREAM_HEDGE_BUDGET das chamadas (com folga de UPSTREAM_HEDGE_BURST cópias)
+UPSTREAM_HEDGE = os.getenv("UPSTREAM_HEDGE", "0") == "1"
+UPSTREAM_HEDGE_BUDGET = float(os.getenv("UPSTREAM_HEDGE_BUDGET", "0.05"))
+UPSTREAM_HEDGE_BURST = float(os.getenv("UPSTREAM_HEDGE_BURST", "10"))
+UPSTREAM_HEDGE_MIN_DELAY = float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "0.05"))
+
+# --- Configuração dos caches ---
+GEOCODING_CACHE_TTL = float(os.getenv("GEOCODING_CACHE_TTL", "86400"))
+GEOCODING_CACHE_MAX_ENTRIES = int(os.getenv("GEOCODING_CACHE_MAX_ENTRIES", "2000"))
+GEOCODING_CACHE_MAX_BYTES = int(os.getenv("GEOCODING_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+GEOCODING_STALE_WHILE_REVALIDATE = float(os.getenv("GEOCODING_STALE_WHILE_REVALIDATE", str(7 * 86400)))
+GEOCODING_STALE_IF_ERROR = float(os.getenv("GEOCODING_STALE_IF_ERROR", str(30 * 86400)))
+FORECAST_CACHE_MAX_ENTRIES = int(os.getenv("FORECAST_CACHE_MAX_ENTRIES", "5000"))
+FORECAST_CACHE_MAX_BYTES = int(os.getenv("FORECAST_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Depois de expirada, a previsão ainda é servida enquanto é revalidada em segundo plano
+# (stale-while-revalidate) ou quando a Open-Meteo falha (stale-if-error)
+FORECAST_STALE_WHILE_REVALIDATE = float(os.getenv("FORECAST_STALE_WHILE_REVALIDATE", str(6 * 3600)))
+FORECAST_STALE_IF_ERROR = float(os.getenv("FORECAST_STALE_IF_ERROR", str(24 * 3600)))
+
+# --- Cache distribuído entre réplicas ---
+# Lista fixa com a URL base de todas as réplicas (inclusive esta) e a URL desta;
+# PEERS vazio desliga
+PEERS = [peer.strip().rstrip('/') for peer in os.getenv("PEERS", "").split(',') if peer.strip()]
+PEER_SELF = os.getenv("PEER_SELF", "").rstrip('/')
+PEER_VIRTUAL_NODES = int(os.getenv("PEER_VIRTUAL_NODES", "100"))
+PEER_CONNECT_TIMEOUT = float(os.getenv("PEER_CONNECT_TIMEOUT", "1"))
+# Maior que o timeout upstream: o dono pode estar buscando na Open-Meteo
+PEER_READ_TIMEOUT = float(os.getenv("PEER_READ_TIMEOUT", "12"))
+# Fração das respostas vindas de outra réplica que também ficam no cache local
+PEER_HOT_REPLICATION = float(os.getenv("PEER_HOT_REPLICATION", "0.1"))
+
+# --- Controle de admissão ---
+# Buscas na Open-Meteo simultâneas por endpoint; as demais esperam numa fila de até
+# ADMISSION_QUEUE_SIZE por no máximo ADMISSION_QUEUE_TIMEOUT segundos. Respostas
+# em cache não passam por aqui.
+FORECAST_CONCURRENCY = int(os.getenv("FORECAST_CONCURRENCY", "16"))
+GEOCODING_CONCURRENCY = int(os.getenv("GEOCODING_CONCURRENCY", "8"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+
+# --- Configuração do endpoint em lote ---
+# A Open-Meteo aceita várias coordenadas separadas por vírgula em uma única chamada
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "50"))
+BATCH_MAX_POINTS = int(os.getenv("BATCH_MAX_POINTS", "1000"))
+# Resolução (graus) da grade dos modelos: pontos na mesma célula compartilham a previsão
+FORECAST_GRID_RESOLUTION = float(os.getenv("FORECAST_GRID_RESOLUTION", "0.1"))
+# Os modelos rodam a cada N horas (00/06/12/18 UTC) e ficam disponíveis após um atraso
+MODEL_RUN_INTERVAL_HOURS = float(os.getenv("MODEL_RUN_INTERVAL_HOURS", "6"))
+MODEL_RUN_DELAY_HOURS = float(os.getenv("MODEL_RUN_DELAY_HOURS", "4"))
+
+# --- Dados locais ---
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+# Raster de distância até a costa, gerado por build_coastline.py
+COASTLINE_RASTER_PATH = os.getenv("COASTLINE_RASTER_PATH", os.path.join(DATA_DIR, "coastline.bin"))
+# Pontos em terra mais longe que isso da costa não consultam a API marinha (máx. 254)
+MARINE_MAX_COAST_DISTANCE_KM = int(os.getenv("MARINE_MAX_COAST_DISTANCE_KM", "50"))
+# Gazetteer offline (GeoNames), gerado por build_gazetteer.py; a geocodificação remota
+# só é usada quando a busca local não encontra nada
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", os.path.join(DATA_DIR, "gazetteer.bin"))
+# Cache persistente (SQLite em modo WAL) compartilhado pelos workers do host;
+# PERSISTENT_CACHE_PATH vazio desliga
+PERSISTENT_CACHE_PATH = os.getenv("PERSISTENT_CACHE_PATH", os.path.join(DATA_DIR, "cache.sqlite3"))
+PERSISTENT_CACHE_WARMUP_ENTRIES = int(os.getenv("PERSISTENT_CACHE_WARMUP_ENTRIES", "2000"))
+PERSISTENT_CACHE_COMPACT_INTERVAL = float(os.getenv("PERSISTENT_CACHE_COMPACT_INTERVAL", "600"))
+PERSISTENT_CACHE_MAX_ROWS = int(os.getenv("PERSISTENT_CACHE_MAX_ROWS", "200000"))
+PERSISTENT_CACHE_WRITE_QUEUE = int(os.getenv("PERSISTENT_CACHE_WRITE_QUEUE", "1000"))
+GAZETTEER_MIN_FUZZY_SCORE = float(os.getenv("GAZETTEER_MIN_FUZZY_SCORE", "0.45"))
+# Máximo de sugestões por prefixo em /cities/suggest
+SUGGEST_TOP_K = 10
+# Geocodificação reversa: tamanho (graus) das células da grade e distância máxima
+# para considerar uma cidade como rótulo de uma coordenada
+NEAREST_GRID_DEGREES = float(os.getenv("NEAREST_GRID_DEGREES", "0.5"))
+NEAREST_CITY_MAX_KM = float(os.getenv("NEAREST_CITY_MAX_KM", "30"))
+
+# --- Variáveis pedidas à Open-Meteo ---
+# Sensação térmica: "daily" usa os agregados diários da Open-Meteo; "hourly" baixa a
+# série horária e agrega no backend (para modelos sem os agregados diários)
+APPARENT_TEMPERATURE_SOURCE = os.getenv("APPARENT_TEMPERATURE_SOURCE", "daily")
+
+# Campo de DailyForecast -> (origem, variável da Open-Meteo); origem é "daily" ou
+# "hourly" (API padrão) ou "marine" (API marinha)
+FIELD_VARIABLES = {
+    'temperature_max': ('daily', 'temperature_2m_max'),
+    'temperature_min': ('daily', 'temperature_2m_min'),
+    'uv_index_max': ('daily', 'uv_index_max'),
+    'precipitation_probability_max': ('daily', 'precipitation_probability_max'),
+    'wave_height_max': ('marine', 'wave_height_max'),
+}
+if APPARENT_TEMPERATURE_SOURCE == "hourly":
+    FIELD_VARIABLES['sensacao_termica'] = ('hourly', 'apparent_temperature')
+    FIELD_VARIABLES['sensacao_termica_max'] = ('hourly', 'apparent_temperature')
+    FIELD_VARIABLES['sensacao_termica_min'] = ('hourly', 'apparent_temperature')
+else:
+    FIELD_VARIABLES['sensacao_termica'] = ('daily', 'apparent_temperature_mean')
+    FIELD_VARIABLES['sensacao_termica_max'] = ('daily', 'apparent_temperature_max')
+    FIELD_VARIABLES['sensacao_termica_min'] = ('daily', 'apparent_temperature_min')
+FORECAST_FIELDS = tuple(FIELD_VARIABLES)
+# Pedida à API padrão só para obter as datas quando apenas campos marinhos foram pedidos
+DATES_ONLY_DAILY_VARIABLE = 'weather_code'
+
+class ForecastVariables(NamedTuple):
+    daily: str
+    hourly: str
+    marine: str
+
+
+def forecast_variables(fields) -> ForecastVariables:
+    # Conjunto mínimo de variáveis (e de chamadas) para os campos pedidos
+    selected = {'daily': [], 'hourly': [], 'marine': []}
+    for field in fields:
+        source, variable = FIELD_VARIABLES[field]
+        if variable not in selected[source]:
+            selected[source].append(variable)
+    return ForecastVariables(*(','.join(selected[source]) for source in ForecastVariables._fields))
+
+
+FULL_FORECAST_VARIABLES = forecast_variables(FORECAST_FIELDS)
+
 # --- Modelos Pydantic ---
 class Link(BaseModel):
     href: str
@@ -32,114 +192,1677 @@ class CityInfoWithLinks(BaseModel):
     links: CityLinks
 
 class DailyForecast(BaseModel):
+    # Com fields= só os campos pedidos são preenchidos (e serializados)
     date: str
-    temperature_max: float
-    temperature_min: float
-    uv_index_max: float
-    precipitation_probability_max: float
+    temperature_max: Optional[float] = None
+    temperature_min: Optional[float] = None
+    uv_index_max: Optional[float] = None
+    precipitation_probability_max: Optional[float] = None
     wave_height_max: Optional[float] = None
     sensacao_termica: Optional[float] = None
+    sensacao_termica_max: Optional[float] = None
+    sensacao_termica_min: Optional[float] = None
 
 class WeatherResponse(BaseModel):
     local: str
     forecast: List[DailyForecast]
     links: List[Link]
+    # Campos que vieram None porque a fonte deles estava indisponível
+    degraded: List[str] = []
+
+class NearestCityInfo(CityInfoWithLinks):
+    distance_km: float
+
+class Coordinate(BaseModel):
+    latitude: float
+    longitude: float
+
+class ForecastPoint(Coordinate):
+    local: str = ""
+
+class BatchForecastRequest(BaseModel):
+    points: List[ForecastPoint]
+    forecast_days: int = 7
+
+class BatchForecastItem(BaseModel):
+    latitude: float
+    longitude: float
+    forecast: Optional[WeatherResponse] = None
+    error: Optional[str] = None
+
+# --- Circuit breaker ---
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+class CircuitBreaker:
+    # Janela deslizante com as últimas chamadas a um endpoint. Com o circuito aberto
+    # as chamadas falham na hora, sem ocupar conexão nem worker; depois de
+    # open_seconds uma única chamada de teste (half-open) decide se ele fecha.
+    def __init__(self, name: str, window: int, min_calls: int, failure_rate: float, slow_call_seconds: float,
+                 open_seconds: float):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self._calls = deque(maxlen=window)  # (falhou, duração)
+        self._latencies = deque(maxlen=UPSTREAM_LATENCY_WINDOW)
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.open_seconds:
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record(self, failed: bool, duration: float):
+        failed = failed or duration > self.slow_call_seconds
+        with self._lock:
+            self._calls.append((failed, duration))
+            if not failed:
+                self._latencies.append(duration)
+            if self.state == 'half-open':
+                if failed:
+                    self._open()
+                else:
+                    self.state = 'closed'
+                    self._calls.clear()
+            elif self.state == 'closed' and len(self._calls) >= self.min_calls \
+                    and self._failures() / len(self._calls) >= self.failure_rate:
+                self._open()
+                logger.warning(f"Circuito aberto para {self.name} após {self._failures()} falhas em {len(self._calls)} chamadas.")
+
+    def _open(self):
+        self.state = 'open'
+        self._opened_at = time.monotonic()
+
+    def _failures(self) -> int:
+        return sum(failed for failed, _ in self._calls)
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < self.min_calls:
+                return None
+            durations = sorted(self._latencies)
+        return durations[min(int(len(durations) * q), len(durations) - 1)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            state, calls, failures = self.state, len(self._calls), self._failures()
+        return {
+            'state': state,
+            'calls': calls,
+            'failure_rate': failures / calls if calls else 0.0,
+            'latency_p50': self.latency_percentile(0.5),
+            'latency_p95': self.latency_percentile(0.95),
+        }
+
+
+class HedgeBudget:
+    # Cada chamada elegível deposita `ratio` fichas (até `burst`) e cada cópia gasta
+    # uma: no longo prazo no máximo `ratio` das chamadas são duplicadas.
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# --- Cliente HTTP ---
+class UpstreamClient:
+    # Uma sessão por worker: as conexões (TCP+TLS) com cada host da Open-Meteo
+    # ficam no pool e são reaproveitadas via keep-alive entre requisições.
+    def __init__(self, pool_maxsize: int, connect_timeout: float, read_timeout: float,
+                 hedge_budget: Optional[HedgeBudget] = None):
+        self.session = requests.Session()
+        # Um pool por host (geocoding, api, marine-api) que guarda até pool_maxsize
+        # conexões. Sem pool_block: o requests não repassa pool_timeout ao urllib3 e a
+        # espera por uma conexão livre prenderia a thread do threadpool sem limite,
+        # fora dos timeouts; acima do limite abre-se uma conexão extra, descartada depois.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self.breakers = {}
+        self._breakers_lock = threading.Lock()
+        self.hedge_budget = hedge_budget
+        self.hedges = {}
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        with self._breakers_lock:
+            if url not in self.breakers:
+                self.breakers[url] = CircuitBreaker(url, BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATE,
+                                                    BREAKER_SLOW_CALL_SECONDS, BREAKER_OPEN_SECONDS)
+            return self.breakers[url]
+
+    def get_json(self, url: str, params: dict):
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuito aberto para {url}")
+        start = time.monotonic()
+        try:
+            response = self.session.get(url, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except requests.exceptions.HTTPError as e:
+            # Erros 4xx são do pedido, não indicam endpoint com problema
+            client_error = e.response is not None and e.response.status_code < 500
+            breaker.record(not client_error, time.monotonic() - start)
+            raise
+        except requests.exceptions.RequestException:
+            breaker.record(True, time.monotonic() - start)
+            raise
+        breaker.record(False, time.monotonic() - start)
+        return data
+
+    async def fetch_json(self, url: str, params: dict, hedge: bool = False):
+        # requests é bloqueante: roda na threadpool para permitir chamadas concorrentes
+        if not hedge or self.hedge_budget is None:
+            return await run_in_threadpool(self.get_json, url, params)
+        return await self.fetch_hedged(url, params)
+
+    async def fetch_hedged(self, url: str, params: dict):
+        # Se a chamada passar do p95 observado, uma cópia sai em paralelo e vale a
+        # primeira resposta com sucesso. A thread da perdedora não pode ser
+        # interrompida: a tarefa dela é cancelada e o resultado, descartado.
+        self.hedge_budget.deposit()
+        delay = self.breaker(url).latency_percentile(0.95)
+        attempts = [asyncio.ensure_future(run_in_threadpool(self.get_json, url, params))]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(attempts, timeout=max(delay, UPSTREAM_HEDGE_MIN_DELAY))
+                if not done and self.hedge_budget.withdraw():
+                    self.hedges[url] = self.hedges.get(url, 0) + 1
+                    attempts.append(asyncio.ensure_future(run_in_threadpool(self.get_json, url, params)))
+            pending, error = set(attempts), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        return attempt.result()
+                    error = attempt.exception()
+            raise error
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+                    attempt.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def stats(self) -> dict:
+        with self._breakers_lock:
+            breakers = dict(self.breakers)
+        return {url: dict(breaker.stats(), hedges=self.hedges.get(url, 0)) for url, breaker in breakers.items()}
+
+    def close(self):
+        self.session.close()
+
+
+def enable_http2():
+    try:
+        import urllib3.http2
+        urllib3.http2.inject_into_urllib3()
+        logger.info("HTTP/2 habilitado para o cliente upstream.")
+    except ImportError as e:
+        logger.warning(f"HTTP/2 indisponível, usando HTTP/1.1: {e}")
+
+
+upstream: Optional[UpstreamClient] = None
+
+# --- Distância até a costa ---
+# Arquivo: cabeçalho + grade rows x cols de uint8, linha 0 ao sul (lat0) e coluna 0 em lon0.
+# Cada célula guarda 0 para mar ou a distância até o mar em km (1..255, saturada) para terra.
+COASTLINE_MAGIC = b'CST1'
+COASTLINE_HEADER = struct.Struct('<4sHfffII')  # magic, versão, resolução, lat0, lon0, rows, cols
+
+class CoastlineRaster:
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.resolution, self.lat0, self.lon0, self.rows, self.cols = COASTLINE_HEADER.unpack_from(self._mm, 0)
+        if magic != COASTLINE_MAGIC or version != 1:
+            self.close()
+            raise ValueError(f"{path} não é um raster de costa válido")
+        if len(self._mm) < COASTLINE_HEADER.size + self.rows * self.cols:
+            self.close()
+            raise ValueError(f"{path} está truncado")
+
+    def distance_km(self, latitude: float, longitude: float) -> int:
+        row = min(max(int((latitude - self.lat0) / self.resolution), 0), self.rows - 1)
+        col = int((longitude - self.lon0) / self.resolution) % self.cols
+        return self._mm[COASTLINE_HEADER.size + row * self.cols + col]
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+coastline: Optional[CoastlineRaster] = None
+
+def needs_marine(latitude: float, longitude: float) -> bool:
+    # Sem raster carregado, a API marinha é sempre consultada
+    if coastline is None:
+        return True
+    return coastline.distance_km(latitude, longitude) <= MARINE_MAX_COAST_DISTANCE_KM
+
+
+def load_coastline():
+    global coastline
+    if not os.path.exists(COASTLINE_RASTER_PATH):
+        logger.info(f"Raster de costa não encontrado em {COASTLINE_RASTER_PATH}; API marinha sempre consultada.")
+        return
+    try:
+        coastline = CoastlineRaster(COASTLINE_RASTER_PATH)
+        logger.info(f"Raster de costa carregado ({coastline.rows}x{coastline.cols}, {coastline.resolution}°).")
+    except (OSError, ValueError, struct.error) as e:
+        logger.error(f"Erro ao carregar o raster de costa: {e}")
+
+# --- Cache em memória ---
+class CacheEntry(NamedTuple):
+    value: object
+    age: float        # segundos desde que o valor foi obtido da Open-Meteo
+    ttl: float        # segundos até expirar; negativo quando já está vencido (stale)
+
+
+class TTLCache:
+    # LRU limitado por número de entradas e por bytes, com expiração por entrada.
+    # Entradas vencidas são mantidas por mais max(stale_while_revalidate, stale_if_error)
+    # segundos para poderem ser servidas como stale. Thread-safe.
+    # Com uma camada persistente (attach), as escritas vão também para o SQLite (por uma
+    # fila, sem esperar o banco) e lookup busca lá as faltas em memória antes de
+    # contá-las como miss.
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int,
+                 stale_while_revalidate: float = 0, stale_if_error: float = 0, namespace: str = ""):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.stale_window = max(stale_while_revalidate, stale_if_error)
+        self.namespace = namespace
+        self.store: Optional['PersistentCache'] = None
+        self.on_load: Optional[Callable] = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.current_bytes = 0
+        self._data = OrderedDict()  # key -> (stored_at, expires_at, size, value)
+        self._lock = threading.Lock()
+
+    def attach(self, store: 'PersistentCache', warmup_entries: int = 0, on_load: Optional[Callable] = None):
+        # on_load recebe cada valor que chega do SQLite (aquecimento e read-through),
+        # para quem mantém estruturas derivadas do cache, como o índice de cidades
+        self.store = store
+        self.on_load = on_load
+        # Worker recém-iniciado: traz para a memória as entradas mais recentes
+        wall, now = time.time(), time.monotonic()
+        for key, value, stored_wall, expires_wall in store.recent(self.namespace, warmup_entries):
+            if self._insert(key, value, now - (wall - stored_wall), now + (expires_wall - wall)) and on_load is not None:
+                on_load(value)
+
+    async def lookup(self, key) -> Optional[CacheEntry]:
+        # Numa falta em memória consulta o SQLite numa thread: um lock do banco
+        # (timeout de até 5s) não pode travar o loop de eventos
+        entry = self._memory_entry(key, time.monotonic())
+        if entry is None and self.store is not None:
+            entry = await run_in_threadpool(self._read_through, key)
+        return self._count(entry, time.monotonic())
+
+    async def get_many(self, keys: list) -> dict:
+        # Valores ainda frescos; as faltas em memória vão ao SQLite numa única ida à thread
+        now = time.monotonic()
+        entries = {key: self._memory_entry(key, now) for key in keys}
+        missing = [key for key, entry in entries.items() if entry is None]
+        if missing and self.store is not None:
+            entries.update(await run_in_threadpool(lambda: {key: self._read_through(key) for key in missing}))
+        now = time.monotonic()
+        found = {}
+        for key, entry in entries.items():
+            entry = self._count(entry, now)
+            if entry is not None and entry.ttl > 0:
+                found[key] = entry.value
+        return found
+
+    def _memory_entry(self, key, now: float):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and now - entry[1] > self.stale_window:
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def _count(self, entry, now: float) -> Optional[CacheEntry]:
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] > now:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+        return CacheEntry(entry[3], now - entry[0], entry[1] - now)
+
+    def _read_through(self, key):
+        row = self.store.get(self.namespace, key)
+        if row is None:
+            return None
+        value, stored_wall, expires_wall = row
+        wall, now = time.time(), time.monotonic()
+        if wall - expires_wall > self.stale_window:
+            return None
+        stored_at, expires_at = now - (wall - stored_wall), now + (expires_wall - wall)
+        if not self._insert(key, value, stored_at, expires_at, replace=False):
+            # Um valor novo chegou à memória enquanto o SQLite era consultado
+            return self._memory_entry(key, now)
+        if self.on_load is not None:
+            self.on_load(value)
+        with self._lock:
+            self.persistent_hits += 1
+        return (stored_at, expires_at, None, value)
+
+    def peek(self, key) -> Optional[CacheEntry]:
+        # Como lookup, mas sem contar hit/miss, sem alterar a ordem LRU e só em memória
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            return CacheEntry(entry[3], now - entry[0], entry[1] - now)
+
+    def set(self, key, value, expires_at: Optional[float] = None):
+        self.set_many([(key, value)], expires_at)
+
+    def set_many(self, items: list, expires_at: Optional[float] = None):
+        now = time.monotonic()
+        if expires_at is None:
+            expires_at = now + self.ttl
+        stored = [(key, value) for key, value in items if self._insert(key, value, now, expires_at)]
+        if self.store is not None and stored:
+            wall = time.time()
+            self.store.put_many_later(self.namespace, stored, wall, wall + (expires_at - now), self.stale_window)
+
+    def _insert(self, key, value, stored_at: float, expires_at: float, replace: bool = True) -> bool:
+        size = len(json.dumps(value, ensure_ascii=False, default=str).encode())
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._data and not replace:
+                return False
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (stored_at, expires_at, size, value)
+            self.current_bytes += size
+            while len(self._data) > self.max_entries or self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+        return True
+
+    def _remove(self, key):
+        size = self._data.pop(key)[2]
+        self.current_bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.stale_hits + self.misses
+            return {
+                'entries': len(self._data),
+                'bytes': self.current_bytes,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'persistent_hits': self.persistent_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.stale_hits) / total if total else 0.0,
+            }
+
+
+# --- Cache persistente (SQLite) ---
+cache_metadata = MetaData()
+cache_entries = Table(
+    'cache_entries', cache_metadata,
+    Column('namespace', String, primary_key=True),
+    Column('key', String, primary_key=True),        # chave do cache em memória, em JSON
+    Column('value', Text, nullable=False),
+    Column('stored_at', Float, nullable=False),     # horários em epoch (time.time)
+    Column('expires_at', Float, nullable=False),
+    Column('stale_until', Float, nullable=False, index=True),
+)
+
+class PersistentCache:
+    # Camada abaixo dos caches em memória, compartilhada entre processos: em modo WAL
+    # leitores não bloqueiam o escritor. Falhas do SQLite só geram log; o cache em
+    # memória e a Open-Meteo continuam atendendo.
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.engine = create_engine(f"sqlite:///{path}", connect_args={'check_same_thread': False, 'timeout': 5})
+
+        @event.listens_for(self.engine, "connect")
+        def set_pragmas(dbapi_connection, _):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+
+        # IF NOT EXISTS: vários workers subindo juntos não disputam o CREATE TABLE
+        with self.engine.begin() as conn:
+            conn.execute(CreateTable(cache_entries, if_not_exists=True))
+            for index in cache_entries.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        # As escritas saem do caminho da requisição: uma thread grava o que entra na fila
+        self._writes = queue.Queue(PERSISTENT_CACHE_WRITE_QUEUE)
+        self._writer = threading.Thread(target=self._write_loop, name="persistent-cache-writer", daemon=True)
+        self._writer.start()
+
+    def get(self, namespace: str, key):
+        query = select(cache_entries.c.value, cache_entries.c.stored_at, cache_entries.c.expires_at).where(
+            cache_entries.c.namespace == namespace, cache_entries.c.key == json.dumps(key))
+        try:
+            with self.engine.connect() as conn:
+                row = conn.execute(query).first()
+        except SQLAlchemyError as e:
+            logger.warning(f"Erro ao ler o cache persistente: {e}")
+            return None
+        return (json.loads(row.value), row.stored_at, row.expires_at) if row is not None else None
+
+    def put_many(self, namespace: str, items: list, stored_at: float, expires_at: float, stale_window: float):
+        rows = [{'namespace': namespace, 'key': json.dumps(key), 'value': json.dumps(value, default=str),
+                 'stored_at': stored_at, 'expires_at': expires_at, 'stale_until': expires_at + stale_window}
+                for key, value in items]
+        statement = sqlite_insert(cache_entries)
+        statement = statement.on_conflict_do_update(
+            index_elements=['namespace', 'key'],
+            set_={column: statement.excluded[column] for column in ('value', 'stored_at', 'expires_at', 'stale_until')},
+        )
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(statement, rows)
+        except SQLAlchemyError as e:
+            logger.warning(f"Erro ao gravar no cache persistente: {e}")
+
+    def put_many_later(self, namespace: str, items: list, stored_at: float, expires_at: float, stale_window: float):
+        try:
+            self._writes.put_nowait((namespace, items, stored_at, expires_at, stale_window))
+        except queue.Full:
+            logger.warning(f"Fila de escrita do cache persistente cheia; {len(items)} entradas descartadas.")
+
+    def _write_loop(self):
+        while True:
+            job = self._writes.get()
+            if job is None:
+                return
+            self.put_many(*job)
+
+    def recent(self, namespace: str, limit: int) -> list:
+        if limit <= 0:
+            return []
+        query = (select(cache_entries.c.key, cache_entries.c.value, cache_entries.c.stored_at, cache_entries.c.expires_at)
+                 .where(cache_entries.c.namespace == namespace, cache_entries.c.expires_at > time.time())
+                 .order_by(cache_entries.c.stored_at.desc())
+                 .limit(limit))
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(query).all()
+        except SQLAlchemyError as e:
+            logger.warning(f"Erro ao ler o cache persistente: {e}")
+            return []
+        return [(tuple(json.loads(row.key)), json.loads(row.value), row.stored_at, row.expires_at) for row in rows]
+
+    def compact(self, max_rows: int) -> int:
+        # Remove o que já passou da janela stale e, acima de max_rows, os mais antigos
+        try:
+            with self.engine.begin() as conn:
+                deleted = conn.execute(delete(cache_entries).where(cache_entries.c.stale_until < time.time())).rowcount
+                total = conn.execute(select(func.count()).select_from(cache_entries)).scalar_one()
+                if total > max_rows:
+                    oldest = (select(cache_entries.c.stored_at).order_by(cache_entries.c.stored_at.desc())
+                              .offset(max_rows).limit(1).scalar_subquery())
+                    deleted += conn.execute(delete(cache_entries).where(cache_entries.c.stored_at < oldest)).rowcount
+            with self.engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        except SQLAlchemyError as e:
+            logger.warning(f"Erro ao compactar o cache persistente: {e}")
+            return 0
+        return deleted
+
+    def close(self):
+        self._writes.put(None)
+        self._writer.join(timeout=5)
+        self.engine.dispose()
+
+
+persistent_cache: Optional[PersistentCache] = None
+
+async def compact_periodically(store: PersistentCache):
+    while True:
+        await asyncio.sleep(PERSISTENT_CACHE_COMPACT_INTERVAL)
+        deleted = await run_in_threadpool(store.compact, PERSISTENT_CACHE_MAX_ROWS)
+        if deleted:
+            logger.info(f"Cache persistente compactado: {deleted} entradas removidas.")
+
+
+# --- Índice local de cidades ---
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * 6371.0 * math.asin(min(1.0, math.sqrt(a)))
+
+
+class CityGrid:
+    # Grade lat/lon de células fixas para achar a cidade mais próxima: a busca percorre
+    # uma janela fixa de linhas e colunas ao redor do ponto, dimensionada para cobrir
+    # max_km, e guarda a candidata mais perto.
+    def __init__(self, cell_degrees: float = NEAREST_GRID_DEGREES):
+        self.cell = cell_degrees
+        self.cols = max(1, round(360 / cell_degrees))
+        self._cells = {}  # (linha, coluna) -> [(lat, lon, ref)]
+
+    def _cell(self, latitude: float, longitude: float):
+        return int((latitude + 90) // self.cell), int((longitude + 180) // self.cell) % self.cols
+
+    def add(self, latitude: float, longitude: float, ref):
+        self._cells.setdefault(self._cell(latitude, longitude), []).append((latitude, longitude, ref))
+
+    def nearest(self, latitude: float, longitude: float, max_km: float):
+        # (distância em km, ref) da mais próxima até max_km, ou None. Visita só as
+        # linhas a até max_km e, em cada linha, as colunas que a largura da célula
+        # naquela latitude exige (perto dos polos, a linha inteira).
+        row, col = self._cell(latitude, longitude)
+        rows = math.ceil(max_km / (self.cell * 110.57))
+        best = None
+        for r in range(row - rows, row + rows + 1):
+            # Largura da célula na borda mais perto do polo
+            edge = min(max(abs(r * self.cell - 90), abs((r + 1) * self.cell - 90)), 90)
+            width = self.cell * 111.32 * math.cos(math.radians(edge))
+            cols = self.cols // 2 if width < 1e-6 else min(self.cols // 2, math.ceil(max_km / width) + 1)
+            for c in range(col - cols, col + cols + 1):
+                for lat, lon, ref in self._cells.get((r, c % self.cols), ()):
+                    distance = haversine_km(latitude, longitude, lat, lon)
+                    if distance <= max_km and (best is None or distance < best[0]):
+                        best = (distance, ref)
+        return best
+
+
+class CityIndex:
+    # Todas as cidades já resolvidas pela geocodificação, por id, com as
+    # SUGGEST_TOP_K mais populosas pré-calculadas para cada prefixo do nome
+    # e uma grade para geocodificação reversa
+    def __init__(self):
+        self._cities = {}
+        self._prefixes = {}  # prefixo normalizado -> [(-população, id), ...]
+        self.grid = CityGrid()
+        self._lock = threading.Lock()
+
+    def add(self, city: dict):
+        self.add_many([city])
+
+    def add_many(self, cities: List[dict]):
+        with self._lock:
+            for city in cities:
+                new = city['id'] not in self._cities
+                self._cities[city['id']] = city
+                if new:
+                    self._index_prefixes(city)
+                    self.grid.add(city['latitude'], city['longitude'], city['id'])
+
+    def _index_prefixes(self, city: dict):
+        entry = (-(city.get('population') or 0), city['id'])
+        key = normalize_name(city['name'])
+        for length in range(1, len(key) + 1):
+            top = self._prefixes.setdefault(key[:length], [])
+            if len(top) < SUGGEST_TOP_K or entry < top[-1]:
+                top.append(entry)
+                top.sort()
+                del top[SUGGEST_TOP_K:]
+
+    def get(self, city_id: int) -> Optional[dict]:
+        return self._cities.get(city_id)
+
+    def suggest(self, prefix: str, limit: int) -> List[dict]:
+        # add_many também roda em threads (read-through do cache persistente) e
+        # reordena as listas de prefixo no lugar
+        with self._lock:
+            top = self._prefixes.get(prefix, [])
+            return [self._cities[city_id] for _, city_id in top[:limit]]
+
+    def nearest(self, latitude: float, longitude: float, max_km: float):
+        with self._lock:
+            found = self.grid.nearest(latitude, longitude, max_km)
+        return (found[0], self._cities[found[1]]) if found is not None else None
+
+    def __len__(self):
+        return len(self._cities)
+
+
+def normalize_name(name: str) -> str:
+    # "São Paulo", " sao  paulo " -> "sao paulo"
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
+
+
+# --- Gazetteer offline ---
+# Arquivo colunar: cabeçalho + seções alinhadas em 4 bytes (ver gazetteer_layout).
+# As cidades ficam ordenadas por população (linha 0 = mais populosa); as chaves de busca
+# (nomes normalizados, incluindo nomes alternativos) ficam ordenadas por bytes para
+# busca por prefixo com bisect, e o índice de trigramas guarda, para cada trigrama
+# (crc32), a lista de linhas cujo nome o contém.
+# Todo prefixo que cobre mais chaves que o limiar do gerador tem suas top_k linhas
+# pré-calculadas; qualquer outro prefixo cobre poucas chaves e é varrido direto.
+GAZETTEER_MAGIC = b'GAZ1'
+GAZETTEER_VERSION = 2
+# magic, versão, cidades, chaves, trigramas, postings, bytes de texto, bytes de chaves,
+# prefixos pré-calculados, bytes de prefixos, top_k
+GAZETTEER_HEADER = struct.Struct('<4sHIIIIIIIII')
+GAZETTEER_EMPTY_ROW = 0xFFFFFFFF
+
+def gazetteer_layout(cities: int, keys: int, trigrams: int, postings: int, text_bytes: int, key_bytes: int,
+                     prefixes: int, prefix_bytes: int, top_k: int):
+    sections = [
+        ('ids', 'I', cities),
+        ('latitude', 'f', cities),
+        ('longitude', 'f', cities),
+        ('population', 'I', cities),
+        ('trigram_counts', 'H', cities),
+        ('id_order', 'I', cities),          # linhas ordenadas por id, para busca por id
+        ('text_offsets', 'I', cities + 1),  # "nome\tpaís\testado\tcódigo do país" de cada linha
+        ('key_offsets', 'I', keys + 1),
+        ('key_rows', 'I', keys),
+        ('trigrams', 'I', trigrams),
+        ('posting_offsets', 'I', trigrams + 1),
+        ('postings', 'I', postings),
+        ('prefix_offsets', 'I', prefixes + 1),
+        ('prefix_top', 'I', prefixes * top_k),  # completadas com GAZETTEER_EMPTY_ROW
+        ('text', 'B', text_bytes),
+        ('keys', 'B', key_bytes),
+        ('prefix_keys', 'B', prefix_bytes),
+    ]
+    layout, offset = {}, GAZETTEER_HEADER.size
+    for name, fmt, count in sections:
+        offset = (offset + 3) & ~3
+        layout[name] = (offset, fmt, count)
+        offset += count * struct.calcsize(fmt)
+    return layout, offset
+
+
+def name_trigrams(normalized: str) -> set:
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigram_code(trigram: str) -> int:
+    return zlib.crc32(trigram.encode())
+
+
+class Gazetteer:
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, *counts = GAZETTEER_HEADER.unpack_from(self._mm, 0)
+        if magic != GAZETTEER_MAGIC or version != GAZETTEER_VERSION:
+            self.close()
+            raise ValueError(f"{path} não é um gazetteer válido")
+        layout, size = gazetteer_layout(*counts)
+        if len(self._mm) < size:
+            self.close()
+            raise ValueError(f"{path} está truncado")
+        self.count = counts[0]
+        self.prefix_count = counts[6]
+        self.top_k = counts[8]
+        view = memoryview(self._mm)
+        self._views = [view]
+        for name, (offset, fmt, count) in layout.items():
+            section = view[offset:offset + count * struct.calcsize(fmt)].cast(fmt)
+            self._views.append(section)
+            setattr(self, name, section)
+        # Trigramas presentes em mais que isso das cidades não ajudam a discriminar
+        self.max_postings = max(1000, self.count // 20)
+        self.grid = CityGrid()
+        for row in range(self.count):
+            self.grid.add(self.latitude[row], self.longitude[row], row)
+
+    def key(self, index: int) -> bytes:
+        return bytes(self.keys[self.key_offsets[index]:self.key_offsets[index + 1]])
+
+    def city(self, row: int) -> dict:
+        text = bytes(self.text[self.text_offsets[row]:self.text_offsets[row + 1]]).decode()
+        name, country, admin1, country_code = text.split('\t')
+        return {
+            'id': self.ids[row],
+            'name': name,
+            'latitude': round(self.latitude[row], 5),
+            'longitude': round(self.longitude[row], 5),
+            'country': country,
+            'country_code': country_code,
+            'admin1': admin1 or None,
+            'population': self.population[row],
+        }
+
+    def get(self, city_id: int) -> Optional[dict]:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ids[self.id_order[mid]] < city_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.ids[self.id_order[lo]] == city_id:
+            return self.city(self.id_order[lo])
+        return None
+
+    def prefix_range(self, prefix: bytes):
+        # [lo, hi) das chaves que começam com prefix
+        lo, hi = 0, len(self.key_rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        start, hi = lo, len(self.key_rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid)[:len(prefix)] == prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+    def top_rows(self, prefix: bytes, limit: int) -> list:
+        # Linhas mais populosas com alguma chave começando com prefix
+        lo, hi = 0, self.prefix_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.prefix_keys[self.prefix_offsets[mid]:self.prefix_offsets[mid + 1]]) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.prefix_count and bytes(self.prefix_keys[self.prefix_offsets[lo]:self.prefix_offsets[lo + 1]]) == prefix:
+            top = self.prefix_top[lo * self.top_k:(lo + 1) * self.top_k]
+            return [row for row in top if row != GAZETTEER_EMPTY_ROW][:limit]
+        # Prefixo sem tabela: cobre poucas chaves
+        start, end = self.prefix_range(prefix)
+        return heapq.nsmallest(limit, set(self.key_rows[start:end]))
+
+    def prefix_rows(self, query: str, limit: int) -> list:
+        # Nome exato antes de prefixo; depois, mais populosa (linha menor) primeiro
+        prefix = query.encode()
+        start, _ = self.prefix_range(prefix)
+        exact = set()
+        while start < len(self.key_rows) and self.key(start) == prefix:
+            exact.add(self.key_rows[start])
+            start += 1
+        rows = sorted(exact)[:limit]
+        rows += [row for row in self.top_rows(prefix, limit) if row not in exact][:limit - len(rows)]
+        return rows
+
+    def fuzzy_rows(self, query: str, limit: int, min_score: float = GAZETTEER_MIN_FUZZY_SCORE) -> list:
+        grams = name_trigrams(query)
+        shared = {}
+        for gram in grams:
+            code = trigram_code(gram)
+            i = bisect_left(self.trigrams, code)
+            if i == len(self.trigrams) or self.trigrams[i] != code:
+                continue
+            start, end = self.posting_offsets[i], self.posting_offsets[i + 1]
+            if end - start > self.max_postings:
+                continue
+            for row in self.postings[start:end]:
+                shared[row] = shared.get(row, 0) + 1
+        scored = []
+        for row, count in shared.items():
+            # Coeficiente de Dice entre os conjuntos de trigramas
+            score = 2 * count / (len(grams) + self.trigram_counts[row])
+            if score >= min_score:
+                scored.append((score, -row))
+        return [-row for _, row in heapq.nlargest(limit, scored)]
+
+    def nearest(self, latitude: float, longitude: float, max_km: float):
+        found = self.grid.nearest(latitude, longitude, max_km)
+        return (found[0], self.city(found[1])) if found is not None else None
+
+    def search(self, name: str, limit: int) -> Tuple[List[dict], List[dict]]:
+        # (por nome exato ou prefixo, aproximadas por trigramas para as vagas restantes).
+        # Só as primeiras provam que a cidade está no gazetteer: uma aproximada pode ser
+        # outra cidade ("Santos" para "Santo André") quando a pedida ficou fora do dump.
+        query = normalize_name(name)
+        if not query:
+            return [], []
+        rows = self.prefix_rows(query, limit)
+        fuzzy = []
+        if len(rows) < limit:
+            seen = set(rows)
+            fuzzy = [row for row in self.fuzzy_rows(query, limit) if row not in seen][:limit - len(rows)]
+        return [self.city(row) for row in rows], [self.city(row) for row in fuzzy]
+
+    def close(self):
+        for view in reversed(getattr(self, '_views', [])):
+            view.release()
+        self._mm.close()
+        self._file.close()
+
+
+gazetteer: Optional[Gazetteer] = None
+
+def load_gazetteer():
+    global gazetteer
+    if not os.path.exists(GAZETTEER_PATH):
+        logger.info(f"Gazetteer não encontrado em {GAZETTEER_PATH}; buscas de cidades usam só a API de geocodificação.")
+        return
+    try:
+        gazetteer = Gazetteer(GAZETTEER_PATH)
+        logger.info(f"Gazetteer carregado ({gazetteer.count} cidades).")
+    except (OSError, ValueError, struct.error) as e:
+        logger.error(f"Erro ao carregar o gazetteer: {e}")
+
+
+def nearest_city(latitude: float, longitude: float, max_km: float = NEAREST_CITY_MAX_KM):
+    # (distância em km, cidade) mais próxima entre o gazetteer e as cidades já resolvidas
+    candidates = [city_index.nearest(latitude, longitude, max_km)]
+    if gazetteer is not None:
+        candidates.append(gazetteer.nearest(latitude, longitude, max_km))
+    candidates = [found for found in candidates if found is not None]
+    return min(candidates, key=lambda found: found[0]) if candidates else None
+
+
+def city_label(city: dict) -> str:
+    return ', '.join(part for part in (city['name'], city.get('admin1'), city.get('country')) if part)
+
+
+def display_label(latitude: float, longitude: float, local: str = "") -> str:
+    if local:
+        return local
+    found = nearest_city(latitude, longitude)
+    return city_label(found[1]) if found is not None else f"{latitude}, {longitude}"
+
+
+# --- Coalescência de requisições (single-flight) ---
+class SingleFlight:
+    # Chamadas concorrentes com a mesma chave aguardam uma única execução
+    # e recebem o mesmo resultado (ou a mesma exceção).
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        # shield: o cancelamento de um cliente não cancela a busca compartilhada
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+# --- Controle de admissão ---
+class Overloaded(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name}: limite de requisições simultâneas atingido")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    # Semáforo com fila limitada e prazo. A espera projetada (posição na fila vezes
+    # o tempo médio de atendimento dividido pelo limite) é avaliada na chegada: se já
+    # passa do prazo, a requisição é recusada na hora em vez de ocupar a fila.
+    # Usado só no loop de eventos, então não precisa de lock.
+    def __init__(self, name: str, limit: int, queue_size: int, queue_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.shed = 0
+        self.service_time = 0.0  # média móvel exponencial, em segundos
+        self._waiters = deque()
+
+    def projected_wait(self, position: int) -> float:
+        return position * self.service_time / self.limit
+
+    def _reject(self, position: int):
+        self.shed += 1
+        raise Overloaded(self.name, self.projected_wait(position))
+
+    async def acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        position = len(self._waiters) + 1
+        if position > self.queue_size or self.projected_wait(position) > self.queue_timeout:
+            self._reject(position)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._waiters.remove(waiter)
+                self._reject(len(self._waiters) + 1)
+            # A vaga chegou junto com o prazo: segue normalmente
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self):
+        # A vaga passa direto para o próximo da fila
+        if self._waiters:
+            self._waiters.popleft().set_result(None)
+        else:
+            self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.service_time = elapsed if self.service_time == 0 else 0.8 * self.service_time + 0.2 * elapsed
+            self.release()
+
+    def stats(self) -> dict:
+        return {'active': self.active, 'queued': len(self._waiters), 'limit': self.limit,
+                'shed': self.shed, 'service_time': self.service_time}
+
+
+def admitted(admission: AdmissionController, fetch):
+    async def admitted_fetch():
+        async with admission.slot():
+            return await fetch()
+    return admitted_fetch
+
+
+forecast_admission = AdmissionController("forecast", FORECAST_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+geocoding_admission = AdmissionController("geocoding", GEOCODING_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+batch_admission = AdmissionController("forecast/batch", BATCH_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+
+
+class CachedResult(NamedTuple):
+    value: object
+    status: str       # HIT, STALE, STALE-IF-ERROR, MISS ou PEER
+    age: float
+    ttl: float
+
+
+# --- Cache distribuído (estilo groupcache) ---
+class PeerRing:
+    # Hash consistente com nós virtuais: cada chave tem uma única réplica dona, e
+    # mudar a lista de réplicas só remaneja as chaves das réplicas afetadas.
+    def __init__(self, peers: list, virtual_nodes: int):
+        points = sorted((zlib.crc32(f"{i}{peer}".encode()), peer) for peer in peers for i in range(virtual_nodes))
+        self._hashes = [h for h, _ in points]
+        self._peers = [peer for _, peer in points]
+
+    def owner(self, route: str) -> str:
+        i = bisect_left(self._hashes, zlib.crc32(route.encode())) % len(self._hashes)
+        return self._peers[i]
+
+
+class PeerRequest(NamedTuple):
+    route: str        # o que define o dono: célula da grade ou nome normalizado
+    path: str         # rota interna atendida pelo dono
+    params: dict
+
+
+peer_ring: Optional[PeerRing] = None
+peer_client: Optional[UpstreamClient] = None
+
+
+async def fetch_from_peer(cache: TTLCache, key, url: str, params: dict, fallback) -> CachedResult:
+    try:
+        body = await peer_client.fetch_json(url, params)
+    except requests.exceptions.HTTPError:
+        # O dono respondeu com erro: ele já tentou a Open-Meteo
+        raise
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Réplica {url} indisponível, buscando {key} direto na Open-Meteo: {e}")
+        return await fallback()
+    # Chaves quentes (ou já replicadas) ficam também aqui até expirarem no dono
+    if body['ttl'] > 0 and (cache.peek(key) is not None or random.random() < PEER_HOT_REPLICATION):
+        cache.set(key, body['value'], expires_at=time.monotonic() + body['ttl'])
+    return CachedResult(body['value'], 'PEER', body['age'], body['ttl'])
+
+
+def peer_response(result: CachedResult) -> dict:
+    return {'value': result.value, 'age': result.age, 'ttl': result.ttl}
+
+
+async def revalidate(flight: SingleFlight, key, fetch):
+    try:
+        await flight.do(key, fetch)
+    except Exception as e:
+        logger.warning(f"Falha ao revalidar {key} em segundo plano: {e}")
+
+
+async def cached_fetch(cache: TTLCache, flight: SingleFlight, key, fetch,
+                       background_tasks: BackgroundTasks, peer: Optional[PeerRequest] = None,
+                       admission: Optional[AdmissionController] = None) -> CachedResult:
+    # fetch() busca na Open-Meteo e grava no cache. Com réplicas configuradas, uma
+    # chave de outra réplica é pedida ao dono em vez de ir à Open-Meteo. Só as buscas
+    # (uma por chave, graças ao single-flight) passam pelo controle de admissão.
+    if peer is not None and peer_ring is not None:
+        owner = peer_ring.owner(peer.route)
+        if owner != PEER_SELF:
+            local_fetch = fetch
+
+            async def fetch():
+                return await fetch_from_peer(cache, key, owner + peer.path, peer.params, local_fetch)
+
+    if admission is not None:
+        fetch = admitted(admission, fetch)
+
+    entry = await cache.lookup(key)
+    if entry is not None and entry.ttl > 0:
+        return CachedResult(entry.value, 'HIT', entry.age, entry.ttl)
+    if entry is not None and -entry.ttl <= cache.stale_while_revalidate:
+        # Serve o valor vencido agora; uma única revalidação roda após a resposta
+        background_tasks.add_task(revalidate, flight, key, fetch)
+        return CachedResult(entry.value, 'STALE', entry.age, entry.ttl)
+    try:
+        value = await flight.do(key, fetch)
+    except (requests.exceptions.RequestException, Overloaded) as e:
+        if entry is not None and -entry.ttl <= cache.stale_if_error:
+            logger.warning(f"Sem resposta nova para {key}, servindo valor vencido: {e}")
+            return CachedResult(entry.value, 'STALE-IF-ERROR', entry.age, entry.ttl)
+        raise
+    if isinstance(value, CachedResult):
+        return value
+    stored = cache.peek(key)
+    return CachedResult(value, 'MISS', 0.0, stored.ttl if stored is not None else 0.0)
+
+
+def set_cache_headers(response: Response, result: CachedResult, cache: TTLCache):
+    response.headers['X-Cache'] = result.status
+    # max-age é o tempo de vida total; quem recebe desconta o Age por conta própria
+    response.headers['Age'] = str(int(result.age))
+    response.headers['Cache-Control'] = (
+        f"public, max-age={max(0, round(result.age + result.ttl))}, "
+        f"stale-while-revalidate={int(cache.stale_while_revalidate)}, "
+        f"stale-if-error={int(cache.stale_if_error)}"
+    )
+
+
+def marine_unavailable(error: Exception) -> dict:
+    # Mesmo formato das respostas de erro da Open-Meteo; wave_height_max fica None
+    return {'error': True, 'reason': str(error)}
+
+
+def degraded_fields(marine_response: dict, fields: tuple = FORECAST_FIELDS) -> List[str]:
+    if not marine_response.get('error'):
+        return []
+    return [field for field in fields if FIELD_VARIABLES[field][0] == 'marine']
+
+
+INVALID_COORDINATES = "Coordenadas fora do intervalo válido (latitude de -90 a 90, longitude de -180 a 180)."
+
+def valid_coordinates(latitude: float, longitude: float) -> bool:
+    # Também recusa NaN, que falha em qualquer comparação
+    return -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+def snap_to_grid(value: float, resolution: float = FORECAST_GRID_RESOLUTION) -> float:
+    return round(round(value / resolution) * resolution, 4)
+
+
+def next_model_run_expiry() -> float:
+    # Instante (em time.monotonic) em que a próxima rodada do modelo fica disponível
+    interval = MODEL_RUN_INTERVAL_HOURS * 3600
+    delay = MODEL_RUN_DELAY_HOURS * 3600
+    now = time.time()
+    next_available = ((now - delay) // interval + 1) * interval + delay
+    return time.monotonic() + (next_available - now)
+
+
+def forecast_expiry(data: list) -> float:
+    # Sem os dados marinhos a previsão só vale até a próxima tentativa do circuito
+    expires_at = next_model_run_expiry()
+    if any(marine.get('error') for _, marine in data):
+        expires_at = min(expires_at, time.monotonic() + BREAKER_OPEN_SECONDS)
+    return expires_at
+
+
+geocoding_cache = TTLCache(GEOCODING_CACHE_TTL, GEOCODING_CACHE_MAX_ENTRIES, GEOCODING_CACHE_MAX_BYTES,
+                           GEOCODING_STALE_WHILE_REVALIDATE, GEOCODING_STALE_IF_ERROR, namespace='geocoding')
+geocoding_flight = SingleFlight()
+city_index = CityIndex()
+# O TTL padrão não é usado: cada previsão expira na próxima rodada do modelo
+forecast_cache = TTLCache(MODEL_RUN_INTERVAL_HOURS * 3600, FORECAST_CACHE_MAX_ENTRIES, FORECAST_CACHE_MAX_BYTES,
+                          FORECAST_STALE_WHILE_REVALIDATE, FORECAST_STALE_IF_ERROR, namespace='forecast')
+forecast_flight = SingleFlight()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global upstream, persistent_cache, peer_ring, peer_client
+    if UPSTREAM_HTTP2:
+        enable_http2()
+    upstream = UpstreamClient(UPSTREAM_POOL_MAXSIZE, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT,
+                              HedgeBudget(UPSTREAM_HEDGE_BUDGET, UPSTREAM_HEDGE_BURST) if UPSTREAM_HEDGE else None)
+    if PEERS and PEER_SELF in PEERS:
+        peer_ring = PeerRing(PEERS, PEER_VIRTUAL_NODES)
+        peer_client = UpstreamClient(UPSTREAM_POOL_MAXSIZE, PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT)
+    elif PEERS:
+        logger.warning(f"PEER_SELF ({PEER_SELF or 'vazio'}) não está em PEERS; cache distribuído desligado.")
+    load_coastline()
+    load_gazetteer()
+    compaction = None
+    if PERSISTENT_CACHE_PATH:
+        try:
+            persistent_cache = await run_in_threadpool(PersistentCache, PERSISTENT_CACHE_PATH)
+        except (OSError, SQLAlchemyError) as e:
+            logger.error(f"Cache persistente indisponível em {PERSISTENT_CACHE_PATH}; seguindo só com a memória: {e}")
+        else:
+            # O índice de cidades é reconstruído a partir das geocodificações guardadas
+            await run_in_threadpool(geocoding_cache.attach, persistent_cache, PERSISTENT_CACHE_WARMUP_ENTRIES,
+                                    city_index.add_many)
+            await run_in_threadpool(forecast_cache.attach, persistent_cache, PERSISTENT_CACHE_WARMUP_ENTRIES)
+            compaction = asyncio.create_task(compact_periodically(persistent_cache))
+    yield
+    if compaction is not None:
+        compaction.cancel()
+        persistent_cache.close()
+    upstream.close()
+    if peer_client is not None:
+        peer_client.close()
+    if coastline is not None:
+        coastline.close()
+    if gazetteer is not None:
+        gazetteer.close()
 
 # --- Aplicação FastAPI ---
-app = FastAPI(title="API de Previsão do Tempo RESTful")
+app = FastAPI(title="API de Previsão do Tempo RESTful", lifespan=lifespan)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    logger.warning(f"Requisição recusada ({exc}); espera projetada de {exc.retry_after:.1f}s.")
+    return JSONResponse(status_code=503, content={'detail': "Servidor sobrecarregado. Tente novamente em instantes."},
+                        headers={'Retry-After': str(max(1, math.ceil(exc.retry_after)))})
+
+def city_with_links(city: dict, base_url: str) -> CityInfoWithLinks:
+    city_links = CityLinks(
+        self=Link(href=f"{base_url}cities/{city['id']}", rel="self", type="GET"),
+        forecast=Link(href=f"{base_url}forecast?latitude={city['latitude']}&longitude={city['longitude']}", rel="forecast", type="GET")
+    )
+    return CityInfoWithLinks(**city, links=city_links)
+
+
+GEOCODING_RESULT_COUNT = 10
+
+async def fetch_geocoding(name: str, background_tasks: BackgroundTasks, peer: bool = True) -> CachedResult:
+    params = {'name': name, 'count': GEOCODING_RESULT_COUNT, 'language': 'pt', 'format': 'json'}
+    cache_key = (normalize_name(name), params['count'], params['language'])
+
+    async def fetch():
+        results = (await upstream.fetch_json(GEOCODING_API_URL, params, hedge=True)).get('results', [])
+        geocoding_cache.set(cache_key, results)
+        city_index.add_many(results)
+        return results
+
+    peer_request = PeerRequest(f"geocoding:{cache_key[0]}", "/peer/geocoding", {'name': name}) if peer else None
+    cached = await cached_fetch(geocoding_cache, geocoding_flight, cache_key, fetch, background_tasks, peer_request,
+                                geocoding_admission)
+    if cached.status == 'PEER':
+        city_index.add_many(cached.value)
+    return cached
+
 
 @app.get("/cities", response_model=List[CityInfoWithLinks])
-def search_cities(name: str, request: Request):
-    params = {'name': name, 'count': 10, 'language': 'pt', 'format': 'json'}
+async def search_cities(name: str, request: Request, response: Response, background_tasks: BackgroundTasks):
+    base_url = str(request.base_url)
+
+    fuzzy = []
+    if gazetteer is not None:
+        matches, fuzzy = gazetteer.search(name, GEOCODING_RESULT_COUNT)
+        if matches:
+            response.headers['X-Cache'] = 'LOCAL'
+            return [city_with_links(city, base_url) for city in matches + fuzzy]
+
     try:
-        response = requests.get(GEOCODING_API_URL, params=params, timeout=10)
-        response.raise_for_status()
-        results = response.json().get('results', [])
-        
-        cities_with_links = []
-        for city in results:
-            city_id = city['id']
-            base_url = str(request.base_url)
-            city_links = CityLinks(
-                self=Link(href=f"{base_url}cities/{city_id}", rel="self", type="GET"),
-                forecast=Link(href=f"{base_url}forecast?latitude={city['latitude']}&longitude={city['longitude']}", rel="forecast", type="GET")
-            )
-            cities_with_links.append(
-                CityInfoWithLinks(**city, links=city_links)
-            )
-            
-        return cities_with_links
+        cached = await fetch_geocoding(name, background_tasks)
+        set_cache_headers(response, cached, geocoding_cache)
+        # Só aproximadas no gazetteer: a API decide, e elas completam as vagas que sobrarem
+        seen = {city['id'] for city in cached.value}
+        extra = [city for city in fuzzy if city['id'] not in seen]
+        results = cached.value + extra[:GEOCODING_RESULT_COUNT - len(cached.value)]
+        return [city_with_links(city, base_url) for city in results]
 
     except requests.exceptions.RequestException as e:
         logger.error(f"Erro na API de Geocodificação: {e}")
         raise HTTPException(status_code=503, detail="Erro ao comunicar com o serviço de geocodificação.")
 
 
-@app.get("/forecast", response_model=WeatherResponse)
-def get_forecast(latitude: float, longitude: float, request: Request, forecast_days: int = 7, local: str = ""):
-    forecast_days = max(1, min(forecast_days, 16))
-    daily_params = "temperature_2m_max,temperature_2m_min,uv_index_max,precipitation_probability_max"
-    
+@app.get("/cities/suggest", response_model=List[CityInfoWithLinks])
+async def suggest_cities(prefix: str, request: Request, limit: int = SUGGEST_TOP_K):
+    # Autocompletar: só índices locais (gazetteer e cidades já resolvidas), sem rede
+    limit = max(1, min(limit, SUGGEST_TOP_K))
+    query = normalize_name(prefix)
+    if not query:
+        return []
+
+    candidates = city_index.suggest(query, limit)
+    if gazetteer is not None:
+        candidates += [gazetteer.city(row) for row in gazetteer.top_rows(query.encode(), limit)]
+    candidates.sort(key=lambda city: -(city.get('population') or 0))
+
+    base_url = str(request.base_url)
+    suggestions, seen = [], set()
+    for city in candidates:
+        if city['id'] not in seen:
+            seen.add(city['id'])
+            suggestions.append(city_with_links(city, base_url))
+    return suggestions[:limit]
+
+
+def nearest_city_info(latitude: float, longitude: float, base_url: str) -> Optional[NearestCityInfo]:
+    if not valid_coordinates(latitude, longitude):
+        return None
+    found = nearest_city(latitude, longitude)
+    if found is None:
+        return None
+    distance, city = found
+    return NearestCityInfo(**city_with_links(city, base_url).model_dump(), distance_km=round(distance, 3))
+
+
+@app.get("/cities/nearest", response_model=NearestCityInfo)
+async def get_nearest_city(latitude: float, longitude: float, request: Request):
+    # Geocodificação reversa só com os índices locais
+    if not valid_coordinates(latitude, longitude):
+        raise HTTPException(status_code=400, detail=INVALID_COORDINATES)
+    city = nearest_city_info(latitude, longitude, str(request.base_url))
+    if city is None:
+        raise HTTPException(status_code=404, detail=f"Nenhuma cidade conhecida a até {NEAREST_CITY_MAX_KM:g} km.")
+    return city
+
+
+@app.post("/cities/nearest", response_model=List[Optional[NearestCityInfo]])
+async def get_nearest_cities(points: List[Coordinate], request: Request):
+    if len(points) > BATCH_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"No máximo {BATCH_MAX_POINTS} pontos por requisição.")
+    base_url = str(request.base_url)
+    return [nearest_city_info(point.latitude, point.longitude, base_url) for point in points]
+
+
+@app.get("/cities/{city_id}", response_model=CityInfoWithLinks)
+async def get_city(city_id: int, request: Request):
+    city = city_index.get(city_id)
+    if city is None and gazetteer is not None:
+        city = gazetteer.get(city_id)
+    if city is None:
+        # Cidade nunca vista por este worker: busca direta por id na geocodificação
+        try:
+            city = await upstream.fetch_json(GEOCODING_GET_API_URL, {'id': city_id, 'language': 'pt'})
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code in (400, 404):
+                raise HTTPException(status_code=404, detail="Cidade não encontrada.")
+            logger.error(f"Erro na API de Geocodificação: {e}")
+            raise HTTPException(status_code=503, detail="Erro ao comunicar com o serviço de geocodificação.")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Erro na API de Geocodificação: {e}")
+            raise HTTPException(status_code=503, detail="Erro ao comunicar com o serviço de geocodificação.")
+        if not city or city.get('id') != city_id:
+            raise HTTPException(status_code=404, detail="Cidade não encontrada.")
+        city_index.add(city)
+
+    return city_with_links(city, str(request.base_url))
+
+
+def forecast_cache_key(latitude: float, longitude: float, forecast_days: int,
+                       variables: ForecastVariables = FULL_FORECAST_VARIABLES):
+    return (latitude, longitude, forecast_days) + tuple(variables)
+
+
+def forecast_api_params(latitude, longitude, forecast_days: int,
+                        variables: ForecastVariables = FULL_FORECAST_VARIABLES):
+    # latitude/longitude podem ser listas separadas por vírgula (vários pontos)
     standard_api_params = {
         'latitude': latitude,
         'longitude': longitude,
-        'daily': daily_params,
-        'hourly': 'apparent_temperature',
         'timezone': 'auto',
         'forecast_days': forecast_days
     }
+    if variables.daily:
+        standard_api_params['daily'] = variables.daily
+    if variables.hourly:
+        standard_api_params['hourly'] = variables.hourly
     
-    try:
-        standard_response = requests.get(STANDARD_API_URL, params=standard_api_params, timeout=10)
-        standard_response.raise_for_status()
-        json_response = standard_response.json()
-        standard_data = json_response.get('daily', {})
-        hourly_data = json_response.get('hourly', {})
+    marine_api_params = {'latitude': latitude, 'longitude': longitude, 
+                        'daily': variables.marine, 
+                        'timezone': 'auto', 
+                        'forecast_days': forecast_days
+                        }
+    return standard_api_params, marine_api_params
 
-        marine_data = {}
-        
-        
-        marine_api_params = {'latitude': latitude, 'longitude': longitude, 
-                            'daily': 'wave_height_max', 
-                            'timezone': 'auto', 
-                            'forecast_days': forecast_days
-                            }
-        marine_response = requests.get(MARINE_API_URL, params=marine_api_params, timeout=10)
-        marine_response.raise_for_status()
-        marine_data = marine_response.json().get('daily', {})
-            
-                
-
-
-        forecast_list = []
-        num_days = len(standard_data.get('time', []))
-        apparent_temp_list = hourly_data.get('apparent_temperature', [])
-
-
-        for i in range(num_days):
-            hourly_index = i * 24
-            sensacao = apparent_temp_list[hourly_index] if hourly_index < len(apparent_temp_list) else None
-            daily_entry = DailyForecast(
-                date=standard_data['time'][i],
-                temperature_max=standard_data['temperature_2m_max'][i],
-                temperature_min=standard_data['temperature_2m_min'][i],
-                uv_index_max=standard_data['uv_index_max'][i],
-                precipitation_probability_max=standard_data['precipitation_probability_max'][i],
-                wave_height_max=marine_data.get('wave_height_max', [None]*num_days)[i],
-                sensacao_termica=sensacao
-            )
-            #print(daily_entry)
-            forecast_list.append(daily_entry)
-            
+
+def parse_fields(fields: Optional[str]) -> tuple:
+    if not fields:
+        return FORECAST_FIELDS
+    requested = {field.strip() for field in fields.split(',') if field.strip()} - {'date'}
+    unknown = requested - set(FIELD_VARIABLES)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Campos inválidos: {', '.join(sorted(unknown))}. "
+                                                    f"Disponíveis: {', '.join(FORECAST_FIELDS)}.")
+    if not requested:
+        raise HTTPException(status_code=400, detail="Nenhum campo de previsão pedido além de date. "
+                                                    f"Disponíveis: {', '.join(FORECAST_FIELDS)}.")
+    # Ordem canônica: a mesma seleção sempre gera a mesma chave de cache
+    return tuple(field for field in FORECAST_FIELDS if field in requested)
+
+
+# Posição de cada campo de sensação térmica em (mín, máx, média) da agregação horária
+HOURLY_AGGREGATE_INDEX = {'sensacao_termica_min': 0, 'sensacao_termica_max': 1, 'sensacao_termica': 2}
+daily_forecast_list = TypeAdapter(List[DailyForecast])
+
+def aggregate_hourly_by_day(times: list, values: list, utc_offset_seconds: int = 0) -> dict:
+    # data local -> (mín, máx, média) em uma única passada pela série horária.
+    # Com timezone=auto os horários já vêm no fuso local (ISO), então dias de
+    # horário de verão com 23 ou 25 horas são agrupados corretamente pela data;
+    # horários em unixtime são convertidos com utc_offset_seconds.
+    totals = {}
+    for t, value in zip(times, values):
+        if value is None:
+            continue
+        if isinstance(t, str):
+            day = t[:10]
+        else:
+            day = datetime.fromtimestamp(t + utc_offset_seconds, tz=timezone.utc).strftime('%Y-%m-%d')
+        acc = totals.get(day)
+        if acc is None:
+            totals[day] = [value, value, value, 1]
+        else:
+            if value < acc[0]:
+                acc[0] = value
+            if value > acc[1]:
+                acc[1] = value
+            acc[2] += value
+            acc[3] += 1
+    return {day: (lo, hi, total / count) for day, (lo, hi, total, count) in totals.items()}
+
+
+def build_daily_forecasts(json_response: dict, marine_response: dict,
+                          fields: tuple = FORECAST_FIELDS) -> List[DailyForecast]:
+    standard_data = json_response.get('daily', {})
+    hourly_data = json_response.get('hourly', {})
+    marine_data = marine_response.get('daily', {})
+
+    # Sem variáveis diárias da API padrão (ex.: fields=wave_height_max) as datas vêm da marinha
+    dates = standard_data.get('time') or marine_data.get('time', [])
+    num_days = len(dates)
+    if num_days == 0:
+        return []
+
+    # Monta as colunas uma vez e valida os tamanhos antes de gerar as linhas
+    columns = {'date': dates}
+    by_day = None
+    for field in fields:
+        source, variable = FIELD_VARIABLES[field]
+        if source == 'daily':
+            columns[field] = standard_data[variable]
+        elif source == 'marine':
+            columns[field] = marine_data.get(variable, [None] * num_days)
+        else:
+            # Sensação térmica: mín/máx/média agregados da série horária
+            if by_day is None:
+                by_day = aggregate_hourly_by_day(hourly_data.get('time', []), hourly_data.get(variable, []),
+                                                 json_response.get('utc_offset_seconds', 0))
+            index = HOURLY_AGGREGATE_INDEX[field]
+            columns[field] = [by_day[day][index] if day in by_day else None for day in dates]
+
+    for field, column in columns.items():
+        if len(column) < num_days:
+            raise IndexError(f"'{field}' tem {len(column)} valores para {num_days} dias")
+
+    names = list(columns)
+    rows = [dict(zip(names, values)) for values in zip(*columns.values())]
+    # Uma única validação (em pydantic-core) para todos os dias
+    return daily_forecast_list.validate_python(rows)
+
+
+async def fetch_forecast_data(latitude: float, longitude: float, forecast_days: int,
+                              background_tasks: BackgroundTasks, fields: tuple = FORECAST_FIELDS,
+                              peer: bool = True) -> CachedResult:
+    latitude, longitude = snap_to_grid(latitude), snap_to_grid(longitude)
+    variables = forecast_variables(fields)
+    cache_key = forecast_cache_key(latitude, longitude, forecast_days, variables)
+    standard_api_params, marine_api_params = forecast_api_params(latitude, longitude, forecast_days, variables)
+
+    if variables != FULL_FORECAST_VARIABLES:
+        # Uma previsão completa em cache também atende a qualquer seleção de campos
+        full = forecast_cache.peek(forecast_cache_key(latitude, longitude, forecast_days))
+        if full is not None and full.ttl > 0:
+            return CachedResult(full.value, 'HIT', full.age, full.ttl)
+
+    marine_needed = bool(variables.marine) and needs_marine(latitude, longitude)
+
+    async def fetch_dates():
+        # Só campos marinhos e nenhuma resposta marinha: as datas vêm da API padrão,
+        # pedida com uma única variável diária
+        params = dict(standard_api_params, daily=DATES_ONLY_DAILY_VARIABLE)
+        return await upstream.fetch_json(STANDARD_API_URL, params, hedge=True)
+
+    async def fetch_standard():
+        if variables.daily or variables.hourly:
+            return await upstream.fetch_json(STANDARD_API_URL, standard_api_params, hedge=True)
+        return {} if marine_needed else await fetch_dates()
+
+    async def fetch_marine():
+        # Ponto no interior (ou ondas não pedidas): wave_height_max fica None
+        if not marine_needed:
+            return {}
+        try:
+            return await upstream.fetch_json(MARINE_API_URL, marine_api_params, hedge=True)
+        except requests.exceptions.RequestException as e:
+            # A previsão padrão continua valendo sem as ondas
+            logger.warning(f"API marinha indisponível, respondendo sem ondas: {e}")
+            return marine_unavailable(e)
+
+    async def fetch():
+        data = list(await asyncio.gather(fetch_standard(), fetch_marine()))
+        if not data[0] and not data[1].get('daily'):
+            data[0] = await fetch_dates()
+        forecast_cache.set(cache_key, data, expires_at=forecast_expiry([data]))
+        return data
+
+    peer_request = None
+    if peer:
+        # Todas as seleções de campos de uma célula têm o mesmo dono
+        peer_params = {'latitude': latitude, 'longitude': longitude, 'forecast_days': forecast_days}
+        if fields != FORECAST_FIELDS:
+            peer_params['fields'] = ','.join(fields)
+        peer_request = PeerRequest(f"forecast:{latitude},{longitude}", "/peer/forecast", peer_params)
+    return await cached_fetch(forecast_cache, forecast_flight, cache_key, fetch, background_tasks, peer_request,
+                              forecast_admission)
+
+
+async def fetch_multi_point(url: str, params: dict, count: int) -> list:
+    if count == 0:
+        return []
+    result = await upstream.fetch_json(url, params)
+    # Com um único ponto a Open-Meteo devolve um objeto em vez de uma lista
+    if isinstance(result, dict):
+        result = [result]
+    if len(result) != count:
+        raise ValueError(f"esperados {count} pontos, recebidos {len(result)}")
+    return result
+
+
+async def fetch_forecast_chunk(cells: list, forecast_days: int) -> list:
+    # Uma chamada padrão para todos os pontos (já na grade) do bloco e uma marinha
+    # só para os que estão perto da costa
+    marine_cells = [cell for cell in cells if needs_marine(*cell)]
+    standard_api_params, _ = forecast_api_params(','.join(str(lat) for lat, _ in cells),
+                                                 ','.join(str(lon) for _, lon in cells), forecast_days)
+    _, marine_api_params = forecast_api_params(','.join(str(lat) for lat, _ in marine_cells),
+                                               ','.join(str(lon) for _, lon in marine_cells), forecast_days)
+    standard, marine = await asyncio.gather(
+        fetch_multi_point(STANDARD_API_URL, standard_api_params, len(cells)),
+        fetch_multi_point(MARINE_API_URL, marine_api_params, len(marine_cells)),
+        return_exceptions=True,
+    )
+    if isinstance(standard, BaseException):
+        raise standard
+    if isinstance(marine, requests.exceptions.RequestException):
+        logger.warning(f"API marinha indisponível, lote de {len(marine_cells)} pontos sem ondas: {marine}")
+        marine = [marine_unavailable(marine)] * len(marine_cells)
+    elif isinstance(marine, BaseException):
+        raise marine
+    marine_by_cell = dict(zip(marine_cells, marine))
+
+    data = [[s, marine_by_cell.get(cell, {})] for cell, s in zip(cells, standard)]
+    forecast_cache.set_many([(forecast_cache_key(lat, lon, forecast_days), value) for (lat, lon), value in zip(cells, data)],
+                            expires_at=forecast_expiry(data))
+    return data
+
+
+@app.get("/forecast", response_model=WeatherResponse, response_model_exclude_unset=True)
+async def get_forecast(latitude: float, longitude: float, request: Request, response: Response,
+                       background_tasks: BackgroundTasks, forecast_days: int = 7, local: str = "",
+                       fields: Optional[str] = None):
+    if not valid_coordinates(latitude, longitude):
+        raise HTTPException(status_code=400, detail=INVALID_COORDINATES)
+    forecast_days = max(1, min(forecast_days, 16))
+    selected_fields = parse_fields(fields)
+
+    try:
+        cached = await fetch_forecast_data(latitude, longitude, forecast_days, background_tasks, selected_fields)
+        set_cache_headers(response, cached, forecast_cache)
+        json_response, marine_response = cached.value
+        forecast_list = build_daily_forecasts(json_response, marine_response, selected_fields)
         
         self_link = Link(href=str(request.url), rel="self", type="GET")
-        display_local = local if local else f"{latitude}, {longitude}"
+        display_local = display_label(latitude, longitude, local)
 
-        return WeatherResponse(local=display_local, forecast=forecast_list, links=[self_link])
+        weather = WeatherResponse(local=display_local, forecast=forecast_list, links=[self_link])
+        degraded = degraded_fields(marine_response, selected_fields)
+        if degraded:
+            weather.degraded = degraded
+        return weather
 
     except requests.exceptions.RequestException as e:
         logger.error(f"Erro de comunicação com a API externa: {e}")
         raise HTTPException(status_code=503, detail=f"Erro ao comunicar com o serviço externo: {e}")
     except (KeyError, IndexError) as e:
         logger.error(f"Erro ao processar dados da API. Erro: {e}")
-        raise HTTPException(status_code=500, detail="Erro ao processar os dados recebidos da API.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Erro ao processar os dados recebidos da API.")
+
+
+@app.post("/forecast/batch", response_model=List[BatchForecastItem])
+async def get_forecast_batch(batch: BatchForecastRequest, request: Request):
+    if len(batch.points) > BATCH_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"No máximo {BATCH_MAX_POINTS} pontos por requisição.")
+    forecast_days = max(1, min(batch.forecast_days, 16))
+
+    # Pontos na mesma célula da grade compartilham uma única previsão. Pontos fora do
+    # intervalo recebem erro próprio e não entram nas chamadas em lote, que a
+    # Open-Meteo recusaria inteiras.
+    cells = {}
+    for point in batch.points:
+        if valid_coordinates(point.latitude, point.longitude):
+            cells[(point.latitude, point.longitude)] = (snap_to_grid(point.latitude), snap_to_grid(point.longitude))
+
+    keys = {cell: forecast_cache_key(*cell, forecast_days) for cell in dict.fromkeys(cells.values())}
+    cached = await forecast_cache.get_many(list(keys.values()))
+    data = {cell: cached[key] for cell, key in keys.items() if key in cached}
+    missing = [cell for cell in keys if cell not in data]
+
+    chunks = [missing[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(missing), BATCH_CHUNK_SIZE)]
+
+    async def fetch_chunk(chunk: list) -> list:
+        async with batch_admission.slot():
+            return await fetch_forecast_chunk(chunk, forecast_days)
+
+    results = await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks), return_exceptions=True)
+    errors = {}
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, (requests.exceptions.RequestException, ValueError)):
+            logger.error(f"Erro de comunicação com a API externa (lote de {len(chunk)} pontos): {result}")
+            errors.update((cell, f"Erro ao comunicar com o serviço externo: {result}") for cell in chunk)
+        elif isinstance(result, Overloaded):
+            errors.update((cell, "Servidor sobrecarregado. Tente novamente em instantes.") for cell in chunk)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            data.update(zip(chunk, result))
+
+    base_url = str(request.base_url)
+    items = []
+    for point in batch.points:
+        cell = cells.get((point.latitude, point.longitude))
+        item = BatchForecastItem(latitude=point.latitude, longitude=point.longitude)
+        if cell is None:
+            item.error = INVALID_COORDINATES
+        elif cell in errors:
+            item.error = errors[cell]
+        else:
+            try:
+                self_link = Link(href=f"{base_url}forecast?latitude={point.latitude}&longitude={point.longitude}&forecast_days={forecast_days}", rel="self", type="GET")
+                display_local = display_label(point.latitude, point.longitude, point.local)
+                item.forecast = WeatherResponse(local=display_local, forecast=build_daily_forecasts(*data[cell]), links=[self_link])
+                degraded = degraded_fields(data[cell][1])
+                if degraded:
+                    item.forecast.degraded = degraded
+            except (KeyError, IndexError) as e:
+                logger.error(f"Erro ao processar dados da API. Erro: {e}")
+                item.error = "Erro ao processar os dados recebidos da API."
+        items.append(item)
+
+    return items
+
+
+# --- Rotas internas do cache distribuído (chamadas pelas outras réplicas) ---
+@app.get("/peer/geocoding", include_in_schema=False)
+async def peer_geocoding(name: str, background_tasks: BackgroundTasks):
+    try:
+        return peer_response(await fetch_geocoding(name, background_tasks, peer=False))
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Erro na API de Geocodificação: {e}")
+        raise HTTPException(status_code=503, detail="Erro ao comunicar com o serviço de geocodificação.")
+
+
+@app.get("/peer/forecast", include_in_schema=False)
+async def peer_forecast(latitude: float, longitude: float, forecast_days: int, background_tasks: BackgroundTasks,
+                        fields: Optional[str] = None):
+    try:
+        return peer_response(await fetch_forecast_data(latitude, longitude, forecast_days, background_tasks,
+                                                       parse_fields(fields), peer=False))
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Erro de comunicação com a API externa: {e}")
+        raise HTTPException(status_code=503, detail=f"Erro ao comunicar com o serviço externo: {e}")
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {'geocoding': geocoding_cache.stats(), 'forecast': forecast_cache.stats()}
+
+
+@app.get("/admission/stats")
+def admission_stats():
+    return {admission.name: admission.stats() for admission in (forecast_admission, geocoding_admission, batch_admission)}
+
+
+@app.get("/upstream/stats")
+def upstream_stats():
+    return upstream.stats()
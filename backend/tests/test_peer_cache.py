@@ -0,0 +1,134 @@
+# Sobe três réplicas do backend (uvicorn) com PEERS/PEER_SELF apontando umas para as
+# outras e uma Open-Meteo falsa em localhost, e confere que cada chave vai uma única
+# vez à Open-Meteo: a réplica dona busca, as demais respondem com X-Cache: PEER.
+# Uso: cd backend && python -m pytest tests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import collections
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("uvicorn")
+requests = pytest.importorskip("requests")
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cada réplica troca as URLs da Open-Meteo pelas do servidor falso antes de subir
+NODE_SCRIPT = """
+import sys
+import uvicorn
+import star
+port, upstream = sys.argv[1], sys.argv[2]
+star.GEOCODING_API_URL = upstream + "/v1/search"
+star.STANDARD_API_URL = upstream + "/v1/forecast"
+star.MARINE_API_URL = upstream + "/v1/marine"
+uvicorn.run(star.app, host="127.0.0.1", port=int(port), log_level="warning")
+"""
+
+
+class FakeOpenMeteo(BaseHTTPRequestHandler):
+    calls = collections.Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self.lock:
+            self.calls[url.path] += 1
+        if url.path == "/v1/search":
+            body = {'results': [{'id': 1, 'name': params['name'], 'latitude': -23.5, 'longitude': -46.6,
+                                 'country': 'Brasil', 'admin1': 'São Paulo', 'population': 1000}]}
+        else:
+            days = int(params.get('forecast_days', 7))
+            daily = {'time': [f"2026-01-{day + 1:02d}" for day in range(days)]}
+            for variable in filter(None, params.get('daily', '').split(',')):
+                daily[variable] = [float(day) for day in range(days)]
+            body = {'utc_offset_seconds': 0, 'daily': daily}
+            if params.get('hourly'):
+                body['hourly'] = {'time': [f"2026-01-{day + 1:02d}T{hour:02d}:00" for day in range(days)
+                                           for hour in range(24)],
+                                  params['hourly']: [20.0] * (24 * days)}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"réplica {url} terminou ao subir (código {process.returncode})")
+        try:
+            requests.get(f"{url}/cache/stats", timeout=1)
+            return
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    raise TimeoutError(f"réplica {url} não respondeu em {timeout}s")
+
+
+@pytest.fixture(scope="module")
+def cluster(tmp_path_factory):
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenMeteo)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}"
+
+    urls = [f"http://127.0.0.1:{free_port()}" for _ in range(3)]
+    processes = []
+    try:
+        for url in urls:
+            # DATA_DIR vazio: sem raster de costa, gazetteer nem cache persistente
+            env = dict(os.environ, PEERS=','.join(urls), PEER_SELF=url, PEER_HOT_REPLICATION='0',
+                       DATA_DIR=str(tmp_path_factory.mktemp("data")), PERSISTENT_CACHE_PATH='')
+            processes.append(subprocess.Popen([sys.executable, "-c", NODE_SCRIPT, url.rsplit(':', 1)[1], upstream_url],
+                                              cwd=BACKEND_DIR, env=env))
+        for url, process in zip(urls, processes):
+            wait_until_up(url, process)
+        yield urls, FakeOpenMeteo.calls
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+        upstream.shutdown()
+
+
+def test_forecast_is_fetched_once_across_replicas(cluster):
+    urls, calls = cluster
+    params = {'latitude': -23.55, 'longitude': -46.63, 'forecast_days': 3}
+    responses = [requests.get(f"{url}/forecast", params=params, timeout=10) for url in urls]
+
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    statuses = [r.headers['X-Cache'] for r in responses]
+    assert statuses.count('PEER') == 2
+    assert set(statuses) - {'PEER'} <= {'MISS', 'HIT'}
+    assert calls['/v1/forecast'] == 1
+    assert calls['/v1/marine'] == 1
+    assert len({json.dumps(r.json()['forecast']) for r in responses}) == 1
+
+
+def test_geocoding_is_fetched_once_across_replicas(cluster):
+    urls, calls = cluster
+    responses = [requests.get(f"{url}/cities", params={'name': 'Cidade Teste'}, timeout=10) for url in urls]
+
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert [r.headers['X-Cache'] for r in responses].count('PEER') == 2
+    assert calls['/v1/search'] == 1
@@ -1,197 +1,317 @@
-from flask import Flask, render_template_string, request
+from flask import Flask, make_response, redirect, render_template, request, url_for
+from jinja2 import FileSystemBytecodeCache
+from requests.adapters import HTTPAdapter
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.http import parse_cache_control_header
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+import hashlib
 import requests
+import os
+import random
+import threading
+import time
 
 app = Flask(__name__)
+# Bytecode dos templates compilados fica em disco (por padrão no diretório
+# temporário), então um processo novo não precisa recompilar index.html
+app.jinja_options = {**app.jinja_options,
+                     'bytecode_cache': FileSystemBytecodeCache(os.getenv("JINJA_BYTECODE_CACHE_DIR") or None)}
+
+# Réplicas do backend (URLs base separadas por vírgula) e rotas usadas
+BACKEND_URLS = [url.strip().rstrip('/') for url in os.getenv("BACKEND_URLS", "http://127.0.0.1:8000").split(',')
+                if url.strip()]
+BACKEND_CITIES_PATH = "/cities"
+BACKEND_FORECAST_PATH = "/forecast"
+
+# Conexões com o backend
+BACKEND_POOL_MAXSIZE = int(os.getenv("BACKEND_POOL_MAXSIZE", "10"))
+BACKEND_RETRIES = int(os.getenv("BACKEND_RETRIES", "2"))
+BACKEND_RETRY_BACKOFF = float(os.getenv("BACKEND_RETRY_BACKOFF", "0.2"))
+BACKEND_CONNECT_TIMEOUT = float(os.getenv("BACKEND_CONNECT_TIMEOUT", "2"))
+BACKEND_READ_TIMEOUT = float(os.getenv("BACKEND_READ_TIMEOUT", "15"))
+# Réplica com BACKEND_EJECT_FAILURES falhas seguidas fica fora por BACKEND_EJECT_SECONDS
+BACKEND_EJECT_FAILURES = int(os.getenv("BACKEND_EJECT_FAILURES", "3"))
+BACKEND_EJECT_SECONDS = float(os.getenv("BACKEND_EJECT_SECONDS", "10"))
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        self.in_flight = 0
+        self.latency = 0.0  # média móvel exponencial das respostas, em segundos
+        self.failures = 0   # falhas seguidas
+        self.ejected_until = 0.0
+
+    def cost(self) -> float:
+        # Réplica sem medições ainda custa 0 e recebe a próxima requisição
+        return (self.in_flight + 1) * self.latency
+
+
+class BackendClient:
+    # Balanceamento no cliente entre as réplicas do backend: de duas réplicas
+    # sorteadas vai para a de menor custo (requisições em andamento x latência
+    # média). Réplicas que falham seguidamente saem do sorteio por um tempo, e um
+    # GET que falhou é repetido em outra réplica.
+    #
+    # As conexões keep-alive ficam num único pool, compartilhado por todas as
+    # threads do servidor WSGI (o dev server do Werkzeug também atende com threads).
+    # Session não é thread-safe, então cada thread tem a sua, todas montadas sobre
+    # o mesmo adapter, que é.
+    def __init__(self, urls: list, pool_maxsize: int, retries: int, backoff: float, connect_timeout: float,
+                 read_timeout: float):
+        self.replicas = [Replica(url) for url in urls]
+        self.retries = retries
+        self.backoff = backoff
+        # pool_block=False: o requests não repassa pool_timeout ao urllib3, então esperar
+        # por uma conexão livre não teria limite nem contaria nos timeouts. Acima de
+        # pool_maxsize abre-se uma conexão extra, descartada ao final.
+        self.adapter = HTTPAdapter(pool_connections=len(urls), pool_maxsize=pool_maxsize, pool_block=False)
+        self.timeout = (connect_timeout, read_timeout)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self._local.session = session
+        return session
+
+    def pick(self, tried: list) -> Replica:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [r for r in self.replicas if r.ejected_until <= now and r not in tried] \
+                or [r for r in self.replicas if r not in tried] or self.replicas
+            if len(candidates) == 1:
+                replica = candidates[0]
+            else:
+                replica = min(random.sample(candidates, 2), key=Replica.cost)
+            replica.in_flight += 1
+        return replica
+
+    def done(self, replica: Replica, elapsed: float, failed: bool):
+        with self._lock:
+            replica.in_flight -= 1
+            if failed:
+                replica.failures += 1
+                if replica.failures >= BACKEND_EJECT_FAILURES:
+                    replica.ejected_until = time.monotonic() + BACKEND_EJECT_SECONDS
+                    app.logger.warning(f"Backend {replica.url} fora do balanceamento por {BACKEND_EJECT_SECONDS:.0f}s.")
+            else:
+                replica.failures = 0
+                replica.latency = elapsed if replica.latency == 0 else 0.7 * replica.latency + 0.3 * elapsed
+
+    def get(self, path: str, params: dict) -> requests.Response:
+        # Repete em falha de conexão, 502, 504 ou 503 com Retry-After (réplica
+        # sobrecarregada); outros 503 são erro na Open-Meteo e valem para todas
+        tried, error = [], None
+        for attempt in range(self.retries + 1):
+            replica = self.pick(tried)
+            if replica in tried:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            tried.append(replica)
+            start = time.monotonic()
+            try:
+                response = self.session.get(replica.url + path, params=params, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                self.done(replica, time.monotonic() - start, failed=True)
+                if not isinstance(e, requests.exceptions.ConnectionError):
+                    raise
+                error = e
+                continue
+            self.done(replica, time.monotonic() - start, failed=response.status_code in (502, 504))
+            retry = response.status_code in (502, 504) or \
+                (response.status_code == 503 and 'Retry-After' in response.headers)
+            if not retry or attempt == self.retries:
+                return response
+        raise error
+
+
+backend = BackendClient(BACKEND_URLS, BACKEND_POOL_MAXSIZE, BACKEND_RETRIES, BACKEND_RETRY_BACKOFF,
+                        BACKEND_CONNECT_TIMEOUT, BACKEND_READ_TIMEOUT)
+
+# --- Cache de páginas renderizadas ---
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "500"))
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+
+class CachedPage(NamedTuple):
+    html: bytes
+    etag: str
+    last_modified: float  # epoch em que o backend buscou a previsão
+    expires_at: float     # time.monotonic
+
+
+class PageCache:
+    # LRU de páginas de previsão já renderizadas, limitado por entradas e por bytes.
+    # Cada página vale enquanto a previsão que a gerou estiver fresca no backend.
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[CachedPage]:
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None:
+                return None
+            if page.expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._pages.move_to_end(key)
+            return page
+
+    def set(self, key, html: str, ttl: float, last_modified: float) -> CachedPage:
+        body = html.encode()
+        page = CachedPage(body, hashlib.sha1(body).hexdigest(), last_modified, time.monotonic() + ttl)
+        if ttl <= 0 or len(body) > self.max_bytes:
+            return page
+        with self._lock:
+            if key in self._pages:
+                self._remove(key)
+            self._pages[key] = page
+            self.current_bytes += len(body)
+            while len(self._pages) > self.max_entries or self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._pages)))
+        return page
+
+    def _remove(self, key):
+        self.current_bytes -= len(self._pages.pop(key).html)
+
+
+page_cache = PageCache(PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_MAX_BYTES)
+
+
+def backend_freshness(response: requests.Response) -> float:
+    # Segundos que a resposta do backend ainda vale (max-age menos Age)
+    cache_control = parse_cache_control_header(response.headers.get('Cache-Control'), cls=ResponseCacheControl)
+    if cache_control.max_age is None:
+        return 0
+    return cache_control.max_age - int(response.headers.get('Age', 0))
+
+
+def cache_control(response, max_age: float):
+    # Páginas com erro não são guardadas por navegadores nem proxies
+    if max_age > 0:
+        response.headers['Cache-Control'] = f"public, max-age={int(max_age)}"
+    else:
+        response.headers['Cache-Control'] = "no-store"
+    return response
+
+
+def page_response(page: CachedPage):
+    # Com ETag e Last-Modified o navegador revalida e recebe 304 sem corpo
+    response = make_response(page.html)
+    response.set_etag(page.etag)
+    response.last_modified = page.last_modified
+    cache_control(response, page.expires_at - time.monotonic())
+    return response.make_conditional(request)
+
+
+def backend_error_status(response: requests.Response) -> int:
+    # Erro do pedido (4xx) é repassado; falha do backend vira 502
+    return response.status_code if response.status_code < 500 else 502
+
+
+# Compilado uma única vez, na inicialização; cada requisição só preenche as variáveis
+INDEX_TEMPLATE = app.jinja_env.get_template("index.html")
+
+# Página inicial e resultados de busca sem Cache-Control do backend (ex.: gazetteer local)
+HOME_MAX_AGE = int(os.getenv("HOME_MAX_AGE", "3600"))
+SEARCH_DEFAULT_MAX_AGE = int(os.getenv("SEARCH_DEFAULT_MAX_AGE", "3600"))
+
+
+def render_page(weather_data=None, error=None, city_list=None, status: int = 200, max_age: float = 0):
+    html = render_template(INDEX_TEMPLATE, 
+                           weather_data=weather_data, 
+                           error=error, 
+                           city_list=city_list,
+                           )
+    return cache_control(make_response(html, status), max_age)
 
-# URLs do backend
-BACKEND_CITIES_URL = "http://127.0.0.1:8000/cities"
-BACKEND_FORECAST_URL = "http://127.0.0.1:8000/forecast"
-
-# --- Template HTML ---
-HTML_TEMPLATE = """
-<!doctype html>
-<html lang="pt-br">
-<head>
-  <meta charset="utf-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0">
-  <title>Previsão do Tempo - Open-Meteo</title>
-  <style>
-    body { font-family: Arial, sans-serif; background-color: #f4f4f4; color: #333; padding: 20px; }
-    .container { max-width: 800px; margin: auto; background: #fff; padding: 20px; border-radius: 8px; box-shadow: 0 4px 10px rgba(0,0,0,0.1); }
-    h1 { text-align: center; color: #007BFF; }
-    form { display: flex; flex-direction: column; gap: 15px; margin-bottom: 20px; }
-    .input-group { display: flex; gap: 10px; align-items: center; }
-    input[type="text"] { flex-grow: 1; padding: 10px; border: 1px solid #ddd; border-radius: 4px; }
-    input[type="number"] { padding: 8px; border: 1px solid #ddd; border-radius: 4px; width: 80px; }
-    button { padding: 10px 15px; background: #007BFF; color: white; border: none; border-radius: 4px; cursor: pointer; }
-    button:hover { background: #0056b3; }
-    .weather-info, .city-list { margin-top: 20px; }
-    .weather-info h2 { font-size: 22px; }
-    .error { color: #d9534f; background-color: #f2dede; border: 1px solid #ebccd1; padding: 15px; border-radius: 4px; text-align: center; }
-    .city-list ul { list-style: none; padding: 0; }
-    .city-list li { margin-bottom: 10px; }
-    .city-selector { width: 100%; background: none; border: 1px solid #007BFF; color: #007BFF; text-align: left; padding: 10px; font-size: 16px; border-radius: 4px; cursor: pointer; transition: background-color 0.2s; }
-    .city-selector:hover, .city-selector.active { background-color: #e6f2ff; }
-    .city-forecast-options { display: none; padding: 15px; margin-top: -1px; border: 1px solid #ddd; border-radius: 0 0 4px 4px; background-color: #f9f9f9; flex-direction: row; align-items: center; gap: 10px; }
-    .accordion-button { display: flex; align-items: center; gap: 15px; background-color: #007BFF; color: white; cursor: pointer; padding: 18px; width: 100%; border: none; text-align: left; outline: none; font-size: 18px; transition: background-color 0.2s; border-radius: 4px; margin-top: 8px; }
-    .accordion-button:hover, .accordion-button.active { background-color: #0056b3; }
-    .accordion-panel { padding: 0 18px; background-color: #f9f9f9; display: none; overflow: hidden; border: 1px solid #ddd; border-top: none; border-radius: 0 0 4px 4px; }
-    .accordion-panel p { margin: 12px 0; font-size: 16px; }
-
-    .header-actions { text-align: center; margin-bottom: 20px; }
-    .home-button {
-        display: inline-block;
-        padding: 10px 20px;
-        background: #007BFF;
-        color: white;
-        text-decoration: none;
-        border-radius: 4px;
-        font-size: 16px;
-        transition: background-color 0.2s;
-    }
-    .home-button:hover {
-        background: #0056b3;
-    }
-  </style>
-</head>
-<body>
-  <div class="container">
-    <h1>Previsão do Tempo</h1>
-
-    {% if city_list or weather_data %}
-      <div class="header-actions">
-        <a href="/" class="home-button">↩️ Voltar ao Início</a>
-      </div>
-    {% endif %}
-    
-    <form method="post">
-      <input type="hidden" name="action" value="search_cities">
-      <div class="input-group">
-        <input type="text" name="cidade" placeholder="Digite o nome da cidade" required>
-        <button type="submit">Buscar</button>
-      </div>
-    </form>
-
-    {% if city_list %}
-      <div class="city-list">
-        <h3>Por favor, selecione a cidade correta:</h3>
-        <ul>
-          {% for city in city_list %}
-            <li>
-              <button type="button" class="city-selector">
-                {{ city.name }}{% if city.admin1 %}, {{ city.admin1 }}{% endif %}, {{ city.country }}
-              </button>
-              <form method="post" class="city-forecast-options">
-                <input type="hidden" name="action" value="get_weather">
-                <input type="hidden" name="latitude" value="{{ city.latitude }}">
-                <input type="hidden" name="longitude" value="{{ city.longitude }}">
-                <input type="hidden" name="local" value="{{ city.name }}{% if city.admin1 %}, {{ city.admin1 }}{% endif %}, {{ city.country }}">
-                
-                <label for="forecast_days_{{city.id}}">Dias:</label>
-                <input type="number" id="forecast_days_{{city.id}}" name="forecast_days" min="1" max="16" value="7">
-                
-                <button type="submit">Obter Previsão</button>
-              </form>
-            </li>
-          {% endfor %}
-        </ul>
-      </div>
-    {% endif %}
-
-    {% if weather_data %}
-      <div class="weather-info">
-        <h2>Previsão para {{ weather_data.local }}</h2>
-        <div class="accordion">
-          {% for day in weather_data.forecast %}
-            <button class="accordion-button">
-              <span>
-                {% if day.precipitation_probability_max <= 35 %} ☀️
-                {% elif day.precipitation_probability_max <= 65 %} ☁️
-                {% else %} 🌧️
-                {% endif %}
-              </span>
-              {{ day.date }}
-            </button>
-            <div class="accordion-panel">
-              <p><strong>🌡️ Temperatura (Máx/Mín):</strong> {{ day.temperature_max }}°C / {{ day.temperature_min }}°C</p>
-              {% if day.sensacao_termica is not none %}
-                <p><strong>🌡️ Sensação Térmica (Início do dia):</strong> {{ day.sensacao_termica }}°C</p>
-              {% endif %}
-              <p><strong>☀️ Índice UV (Máx):</strong> {{ day.uv_index_max }}</p>
-              <p><strong>💧 Chance de Chuva (Máx):</strong> {{ day.precipitation_probability_max }}%</p>
-              {% if day.wave_height_max is not none %}
-                <p><strong>🌊 Ondas (Máx):</strong> {{ day.wave_height_max }} m</p>
-              {% else %} <p><strong>🌊 Sem informações sobre ondas no local!</p>
-                   
-              {% endif %}
-            </div>
-          {% endfor %}
-        </div>
-      </div>
-    {% endif %}
-
-    {% if error %}
-      <div class="error"><p><strong>Erro:</strong> {{ error }}</p></div>
-    {% endif %}
-  </div>
-
-  <script>
-    var acc = document.getElementsByClassName("accordion-button");
-    for (var i = 0; i < acc.length; i++) { acc[i].addEventListener("click", function() { this.classList.toggle("active"); var panel = this.nextElementSibling; if (panel.style.display === "block") { panel.style.display = "none"; } else { panel.style.display = "block"; } }); }
-    var citySelectors = document.getElementsByClassName("city-selector");
-    for (var i = 0; i < citySelectors.length; i++) { citySelectors[i].addEventListener("click", function() { var allOptions = document.getElementsByClassName("city-forecast-options"); for (var j = 0; j < allOptions.length; j++) { if (allOptions[j] !== this.nextElementSibling) { allOptions[j].style.display = "none"; } } var allSelectors = document.getElementsByClassName("city-selector"); for (var k = 0; k < allSelectors.length; k++) { if (allSelectors[k] !== this) { allSelectors[k].classList.remove("active"); } } this.classList.toggle("active"); var optionsPanel = this.nextElementSibling; if (optionsPanel.style.display === "flex") { optionsPanel.style.display = "none"; } else { optionsPanel.style.display = "flex"; } }); }
-  </script>
-
-</body>
-</html>
-"""
 
 @app.route("/", methods=["GET", "POST"])
 def index():
-    weather_data, error_message, city_list = None, None, None
-
     if request.method == "POST":
+        # Formulários antigos (POST com action): redireciona para as URLs em GET,
+        # que podem ser guardadas em cache e recarregadas sem reenviar o formulário
         action = request.form.get("action")
         
         if action == "search_cities":
-            cidade = request.form.get("cidade")
-            if cidade:
-                try:
-                    response = requests.get(BACKEND_CITIES_URL, params={'name': cidade}, timeout=15)
-                    if response.status_code == 200:
-                        city_list = response.json()
-                        if not city_list:
-                            error_message = f"Nenhuma cidade encontrada para '{cidade}'."
-                    else:
-                        error_message = response.json().get("detail", "Erro ao buscar cidades.")
-                except requests.exceptions.RequestException:
-                    error_message = "Não foi possível conectar ao serviço de busca."
-            else:
-                error_message = "Por favor, insira o nome de uma cidade."
+            return redirect(url_for('search', cidade=request.form.get("cidade", "")), code=303)
 
         elif action == "get_weather":
-            params = {
-                "latitude": float(request.form.get("latitude")),
-                "longitude": float(request.form.get("longitude")),
-                "forecast_days": int(request.form.get("forecast_days", 7)),
-                "local": request.form.get("local")
-            }
-            
-            try:
-                response = requests.get(BACKEND_FORECAST_URL, params=params, timeout=15)
-                
-                if response.status_code == 200:
-                    weather_data = response.json()
-                else:
-                    error_message = response.json().get("detail", "Erro ao obter previsão.")
-            except requests.exceptions.RequestException:
-                error_message = "Não foi possível conectar ao serviço de previsão."
-
-    return render_template_string(HTML_TEMPLATE, 
-                                  weather_data=weather_data, 
-                                  error=error_message, 
-                                  city_list=city_list,
-                                  )
+            return redirect(url_for('forecast',
+                                    lat=request.form.get("latitude"),
+                                    lon=request.form.get("longitude"),
+                                    days=request.form.get("forecast_days", 7),
+                                    local=request.form.get("local", "")), code=303)
+
+    return render_page(max_age=HOME_MAX_AGE)
+
+
+@app.route("/search")
+def search():
+    cidade = request.args.get("cidade", "").strip()
+    if not cidade:
+        return render_page(error="Por favor, insira o nome de uma cidade.", status=400)
+
+    try:
+        response = backend.get(BACKEND_CITIES_PATH, params={'name': cidade})
+        if response.status_code == 200:
+            city_list = response.json()
+            if not city_list:
+                return render_page(error=f"Nenhuma cidade encontrada para '{cidade}'.", max_age=SEARCH_DEFAULT_MAX_AGE)
+            max_age = backend_freshness(response) if 'Cache-Control' in response.headers else SEARCH_DEFAULT_MAX_AGE
+            return render_page(city_list=city_list, max_age=max_age)
+        else:
+            error_message = response.json().get("detail", "Erro ao buscar cidades.")
+            return render_page(error=error_message, status=backend_error_status(response))
+    except requests.exceptions.RequestException:
+        error_message = "Não foi possível conectar ao serviço de busca."
+    return render_page(error=error_message, status=502)
+
+
+@app.route("/forecast")
+def forecast():
+    params = {
+        "latitude": request.args.get("lat", type=float),
+        "longitude": request.args.get("lon", type=float),
+        "forecast_days": request.args.get("days", 7, type=int),
+        "local": request.args.get("local", "")
+    }
+    if params["latitude"] is None or params["longitude"] is None:
+        return render_page(error="Latitude e longitude inválidas.", status=400)
+
+    cache_key = (params["latitude"], params["longitude"], params["forecast_days"], params["local"])
+    page = page_cache.get(cache_key)
+    if page is not None:
+        return page_response(page)
+
+    try:
+        response = backend.get(BACKEND_FORECAST_PATH, params=params)
+        
+        if response.status_code == 200:
+            weather_data = response.json()
+            html = render_template(INDEX_TEMPLATE, weather_data=weather_data, error=None, city_list=None)
+            age = int(response.headers.get('Age', 0))
+            # Previsão sem algum campo (API marinha fora) não é guardada: a próxima
+            # requisição já pode vir completa
+            ttl = 0 if weather_data.get('degraded') else backend_freshness(response)
+            page = page_cache.set(cache_key, html, ttl, time.time() - age)
+            return page_response(page)
+        else:
+            error_message = response.json().get("detail", "Erro ao obter previsão.")
+            return render_page(error=error_message, status=backend_error_status(response))
+    except requests.exceptions.RequestException:
+        error_message = "Não foi possível conectar ao serviço de previsão."
+    return render_page(error=error_message, status=502)
 
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
\ No newline at end of file
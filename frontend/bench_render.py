@@ -0,0 +1,36 @@
+# Compara o custo por requisição de recompilar o template a cada chamada
+# (render_template_string, como antes) com o template já compilado (INDEX_TEMPLATE).
+# Uso: python bench_render.py [repetições]
+import sys
+import timeit
+
+from flask import render_template, render_template_string
+
+from app import INDEX_TEMPLATE, app
+
+WEATHER_DATA = {
+    'local': 'São Paulo, São Paulo, Brasil',
+    'forecast': [{
+        'date': f'2025-01-{day:02d}',
+        'temperature_max': 30.1, 'temperature_min': 19.4,
+        'uv_index_max': 9.5, 'precipitation_probability_max': 40,
+        'wave_height_max': None,
+        'sensacao_termica': 26.0, 'sensacao_termica_max': 33.2, 'sensacao_termica_min': 19.0,
+    } for day in range(1, 8)],
+}
+
+
+def bench(label: str, render, number: int):
+    with app.test_request_context('/'):
+        seconds = min(timeit.repeat(render, number=number, repeat=5)) / number
+    print(f"{label:<24} {seconds * 1e6:9.1f} µs/requisição")
+    return seconds
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    source = app.jinja_loader.get_source(app.jinja_env, "index.html")[0]
+    context = {'weather_data': WEATHER_DATA, 'error': None, 'city_list': None}
+    before = bench("render_template_string", lambda: render_template_string(source, **context), number)
+    after = bench("template pré-compilado", lambda: render_template(INDEX_TEMPLATE, **context), number)
+    print(f"{before / after:.1f}x mais rápido")